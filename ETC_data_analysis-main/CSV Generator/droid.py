@@ -3,8 +3,9 @@ Droid Wrapper for python
 	 Authored by Ethan Wolfe
 	 
 	 Usage:
-		droid.py <S|M> <T|S|P> <Working Dir> <Output Dir> <Blacklisted Names>
-		droid.py <R> <Output Dir>
+		droid.py [Options] <S|M> <T|S|P> <Working Dir> <Output Dir> <Blacklisted Names>
+		droid.py [Options] <R> <Output Dir>
+		droid.py [Options] <C> [Days]
 	 
      CSV Type
         S (Single) Generate a single csv output. Doesn't affect Project-Level scans
@@ -15,8 +16,21 @@ Droid Wrapper for python
 		T (Top-Level) - e.g. `D:/`
 		S (Semester-Level) - e.g. `D:/2017_semester_1`
 		P (Project-Level) - e.g. `D:/2017_semester_1/wfk`
-		R (Restart Crashed)
+		R (Restart Crashed) - carries on from the journal.json of the last run, only the chunks that did not finish are scanned again
+		C (Compact the hash cache) - drops the hashes of files not seen in the last Days days (default: 90)
 	
+	Options:
+		--max-jobs N      Number of droid scans (JVMs) running at once. Defaults to the number of cores
+		--job-memory MB   Java heap given to each droid scan
+		--max-memory MB   Memory the droid scans may use together, lowers the number of jobs to fit (1024 MB per job without --job-memory)
+		--native         Scan with the built-in scanner instead of droid: paths, sizes, dates, extensions and SHA-256 hashes, no format identification
+		--hash-threads N Threads hashing files per native scan (default: 4)
+		--chunk-gb N     Directories bigger than this are scanned as one chunk per sub directory, merged into one csv again at the end (default: 50)
+		--database DIR   Load every project csv into the database in DIR (Database Generation.py, with ETC_Past_Projects_Listing.csv in DIR) as soon as its scan is done, while the other scans go on. A database already in DIR is added to (--update)
+		--hash-cache FILE  Cache of the native scan hashes, files with the same device, inode, size and modification time are not hashed again (default: hash_cache.db)
+		The directories are measured first and scanned largest first, so the biggest project doesn't start last.
+		Every stage (droid scan and export, native scan, merge, database load) is written as a JSON line to metrics.jsonl in the output folder, log.txt ends with a summary of it.
+
 	Working Dir:
 		The directory that you want the program to search and call droid on
 	
@@ -35,13 +49,21 @@ Droid Wrapper for python
 	 conflicts caused by old droid profiles that might have the same profile id after generation. This will also save you some much needed disk space
 '''
 
-from os import listdir, getcwd, mkdir, remove
-from os.path import expanduser, join, exists, normpath, basename, dirname
-from subprocess import Popen, PIPE
+from os import listdir, getcwd, mkdir, remove, replace, scandir, cpu_count, environ, stat
+from os.path import expanduser, join, exists, normpath, basename, dirname, splitext, abspath
+from subprocess import Popen, PIPE, STDOUT
 from shutil import copyfile, move
-from sys import argv
+from sys import argv, executable
 from time import time
+from datetime import datetime
+from collections import deque
+from csv import writer, reader, QUOTE_ALL
+from urllib.parse import quote
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import RLock
+import hashlib
+import json
+import sqlite3
 import logging as log
 import platform
 
@@ -49,12 +71,43 @@ if platform.system() == 'Windows':
     DROID_LOCATION = expanduser('~\Droid\droid.bat')
     SIGNATURE_FILE = getcwd() + '\DROID_SignatureFile_V97.xml'
     DROID_PROFILE = getcwd() + '\HashProfile.droid'
+    HASH_CACHE = getcwd() + '\hash_cache.db'
 else:
     DROID_LOCATION = expanduser('~/Droid/droid.sh')
     SIGNATURE_FILE = getcwd() + '/DROID_SignatureFile_V97.xml'
     DROID_PROFILE = getcwd() + '/HashProfile.droid'
+    HASH_CACHE = getcwd() + '/hash_cache.db'
+
+# The database loader droid.py hands the csv files to with --database
+LOADER_LOCATION = join(dirname(abspath(__file__)), '..', 'Database', 'Database Generation.py')
+
+# Droid scans running at once unless told otherwise, and the memory each is assumed to take against --max-memory
+DEFAULT_MAX_JOBS = cpu_count() or 1
+DEFAULT_JOB_MEMORY_MB = 1024
+
+# Directories bigger than this are scanned as a chunk per sub directory, so a restart only redoes the unfinished chunks
+DEFAULT_CHUNK_GB = 50
+
+# Guards the journal and the metrics file, the scan threads all update them
+journal_lock = RLock()
+
+# One JSON line per stage of every job in the output folder, Database Generation.py writes the same kind of lines
+METRICS_FILE = 'metrics.jsonl'
+
+# Native scanner: threads hashing files per scan, bytes read per call, and files hashed ahead of the csv writer
+DEFAULT_HASH_THREADS = 4
+HASH_BUFFER_SIZE = 1024 * 1024
+HASH_QUEUE_SIZE = 256
 
-def get_scan_dirs(working_dir, output, level, blacklisted):
+# Seconds a scan waits on another one writing to the hash cache, and the age in days of the entries compacting it drops by default
+HASH_CACHE_TIMEOUT = 60
+DEFAULT_HASH_CACHE_DAYS = 90
+
+# The columns of a DROID csv export with HashProfile.droid, as Database Generation.py reads them
+droid_csv_header = ['ID', 'PARENT_ID', 'URI', 'FILE_PATH', 'NAME', 'METHOD', 'STATUS', 'SIZE', 'TYPE', 'EXT', 'LAST_MODIFIED',
+                    'EXTENSION_MISMATCH', 'SHA256_HASH', 'FORMAT_COUNT', 'PUID', 'MIME_TYPE', 'FORMAT_NAME', 'FORMAT_VERSION']
+
+def get_scan_dirs(working_dir, level, blacklisted):
     # Figure out which direcotries we want to be looking at
     scan_dirs = []
     if level == 'P':
@@ -71,17 +124,454 @@ def get_scan_dirs(working_dir, output, level, blacklisted):
     for directory in blacklisted:
         if directory in scan_dirs:
             scan_dirs.remove(directory)
-    
-    # Remove folders that finished and Delete droid files that did not generate properly
-    pre_finished = 0
-    for file in listdir(output):
-        if file.endswith('.droid'):
-            if not 'working' in file:
-                scan_dirs.remove(file[:-6].replace('.', '/'))
-                pre_finished += 1
-            else:
-                remove(join(output, file))
-    return pre_finished, scan_dirs
+    return scan_dirs
+
+
+# Quick walk of a directory for its size and file count, only looking at the directory entries
+def estimate_tree(path):
+    size = 0
+    files = 0
+    folders = [path]
+    while len(folders) > 0:
+        try:
+            entries = scandir(folders.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    else:
+                        files += 1
+                        size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    return size, files
+
+
+# Size and file count of the files directly in path, and of each of its sub directories
+def estimate_dir(path):
+    size = 0
+    files = 0
+    sub_dirs = {}
+    try:
+        with scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_dirs[entry.name] = estimate_tree(entry.path)
+                    else:
+                        files += 1
+                        size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return (size, files), sub_dirs
+
+
+def new_scan_job(project, path, recursive, size, files):
+    return {'project': project, 'path': path, 'recursive': recursive, 'size': size, 'files': files, 'status': 'pending', 'seconds': None}
+
+
+# One scan job per directory, except that directories bigger than chunk_size get a job for each of their sub directories
+# and one for the files directly in them. A crash then only loses the chunks that were still running.
+def plan_scan_jobs(working_dir, scan_dirs, jobs, chunk_size):
+    log.info(f'Measuring {len(scan_dirs)} directories')
+    paths = [join(working_dir, directory.replace('.', '/')) for directory in scan_dirs]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        estimates = list(executor.map(estimate_dir, paths))
+
+    scan_jobs = {}
+    for directory, path, (loose, sub_dirs) in zip(scan_dirs, paths, estimates):
+        size = loose[0] + sum(sub_size for sub_size, _ in sub_dirs.values())
+        files = loose[1] + sum(sub_files for _, sub_files in sub_dirs.values())
+        log.info(f'{directory}: {files:,} files, {size / 1024 ** 3:,.1f} GB')
+        if size <= chunk_size or len(sub_dirs) == 0:
+            scan_jobs[directory] = new_scan_job(directory, path, True, size, files)
+            continue
+        log.info(f'Splitting {directory} into {len(sub_dirs) + 1} chunks')
+        scan_jobs[directory + '#'] = new_scan_job(directory, path, False, *loose)
+        for name in sorted(sub_dirs):
+            scan_jobs[f'{directory}#{name}'] = new_scan_job(directory, join(path, name), True, *sub_dirs[name])
+    return scan_jobs
+
+
+# Number of droid scans to run at once within the job and memory limits
+def get_job_count(max_jobs, job_memory, max_memory):
+    jobs = max_jobs
+    if max_memory is not None:
+        jobs = min(jobs, max_memory // (job_memory or DEFAULT_JOB_MEMORY_MB))
+    return max(jobs, 1)
+
+
+# Environment for the droid processes, with the java heap limited when asked for
+def droid_environment(job_memory):
+    if job_memory is None:
+        return None
+    env = dict(environ)
+    env['JAVA_TOOL_OPTIONS'] = (env.get('JAVA_TOOL_OPTIONS', '') + f' -Xmx{job_memory}m').strip()
+    return env
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600}h {seconds % 3600 // 60}m {seconds % 60}s'
+
+
+# Append the metrics of one stage of a job (or of the whole run) to the metrics file of the output folder
+def write_metric(output, stage, name, seconds, **values):
+    record = {'time': datetime.now().isoformat(timespec='seconds'), 'tool': 'droid.py', 'stage': stage, 'name': name, 'seconds': round(seconds, 3)}
+    record.update(values)
+    with journal_lock:
+        with open(join(output, METRICS_FILE), 'a', encoding='utf-8') as file:
+            file.write(json.dumps(record) + '\n')
+
+
+def read_metrics(output):
+    if not exists(join(output, METRICS_FILE)):
+        return []
+    with open(join(output, METRICS_FILE), 'r', encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+# Where the time of the run went: every stage in total, then the projects that took the longest to scan
+def log_metrics_summary(output, top=5):
+    records = read_metrics(output)
+    stages = {}
+    for record in records:
+        if record['stage'] == 'run':
+            continue
+        stage = stages.setdefault(record['stage'], [0, 0, 0])
+        stage[0] += 1
+        stage[1] += record['seconds']
+        stage[2] += record.get('bytes', 0)
+    log.info('Time per stage:')
+    for name, (count, seconds, size) in sorted(stages.items(), key=lambda item: item[1][1], reverse=True):
+        rate = f', {size / 1024 ** 2 / max(seconds, 1):,.1f} MB/s' if size else ''
+        log.info(f'  {name}: {count} x, {format_duration(seconds)}{rate}')
+
+    projects = {}
+    for record in records:
+        if record['stage'] == 'job':
+            project = projects.setdefault(record['project'], [0, 0, 0])
+            project[0] += record['seconds']
+            project[1] += record['bytes']
+            project[2] += record['files']
+    log.info('Slowest projects:')
+    for name, (seconds, size, files) in sorted(projects.items(), key=lambda item: item[1][0], reverse=True)[:top]:
+        log.info(f'  {name}: {format_duration(seconds)}, {size / 1024 ** 3:,.1f} GB, {files:,} files '
+                 f'({files / max(seconds, 1):,.0f} files/s, {size / 1024 ** 2 / max(seconds, 1):,.1f} MB/s)')
+
+
+# Take the flag name out of the arguments
+def pop_flag(args, name):
+    if name not in args:
+        return False
+    args.remove(name)
+    return True
+
+
+# Take `name value` out of the arguments, the rest of them are positional
+def pop_option(args, name, default, kind=int):
+    if name not in args:
+        return default
+    index = args.index(name)
+    value = kind(args[index + 1])
+    del args[index:index + 2]
+    return value
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                break
+            sha256.update(view[:read])
+    return sha256.hexdigest()
+
+
+def droid_uri(path, folder=False):
+    # The drive colon stays as it is, like in DROID's URIs (file:/D:/...)
+    uri = 'file:/' + quote(path.replace('\\', '/').lstrip('/'), safe='/:')
+    return uri + '/' if folder else uri
+
+
+def droid_timestamp(mtime):
+    return datetime.fromtimestamp(mtime).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+# The hash cache is keyed by (device, inode, size, mtime_ns), last_seen is the day the entry was last used.
+# Parallel scans share it, so every write is committed on its own and no scan holds the write lock for longer.
+def open_hash_cache(file):
+    cache = sqlite3.connect(file, timeout=HASH_CACHE_TIMEOUT, isolation_level=None)
+    cache.execute('pragma journal_mode = wal')
+    cache.execute('pragma synchronous = normal')
+    cache.execute('create table if not exists hashes (device integer, inode integer, size integer, mtime_ns integer, '
+                  'sha256 text, last_seen integer, primary key (device, inode, size, mtime_ns)) without rowid')
+    return cache
+
+
+def today():
+    return int(time() // 86400)
+
+
+# A cache that is locked for too long or broken is left alone for the rest of the scan, its files are just hashed
+def disable_hash_cache(error, counts):
+    log.warning(f'Hash cache unavailable, hashing without it: {error}')
+    counts['disabled'] = True
+
+
+# last_seen only moves once a day, so a re-scan of unchanged files doesn't write to the cache
+def lookup_hash(cache, key, counts):
+    if counts['disabled']:
+        return None
+    try:
+        row = cache.execute('select sha256, last_seen from hashes where device = ? and inode = ? and size = ? and mtime_ns = ?', key).fetchone()
+        if row is not None and row[1] < today():
+            cache.execute('update hashes set last_seen = ? where device = ? and inode = ? and size = ? and mtime_ns = ?', (today(),) + key)
+    except sqlite3.Error as e:
+        disable_hash_cache(e, counts)
+        row = None
+    if row is None:
+        counts['misses'] += 1
+        return None
+    counts['hits'] += 1
+    return row[0]
+
+
+def store_hash(cache, key, sha256, counts):
+    if counts['disabled']:
+        return
+    try:
+        cache.execute('insert or replace into hashes values (?, ?, ?, ?, ?, ?)', key + (sha256, today()))
+        counts['stored'] += 1
+    except sqlite3.Error as e:
+        disable_hash_cache(e, counts)
+
+
+# Drop the entries not used in days days and give the space back
+def compact_hash_cache(file, days):
+    cache = open_hash_cache(file)
+    before = cache.execute('select count() from hashes').fetchone()[0]
+    cache.execute('delete from hashes where last_seen < ?', (today() - days,))
+    cache.execute('vacuum')
+    after = cache.execute('select count() from hashes').fetchone()[0]
+    cache.close()
+    return before, after
+
+
+# The row of a folder that is not walked, its own chunk has the rows of what is in it
+def native_folder_row(row_id, parent_id, entry):
+    try:
+        with scandir(entry.path) as entries:
+            status = 'Done' if next(entries, None) is not None else 'Empty'
+    except OSError:
+        status = 'Access denied'
+    modified = droid_timestamp(entry.stat(follow_symlinks=False).st_mtime)
+    return [row_id, parent_id, droid_uri(entry.path, True), entry.path, entry.name, '', status, '', 'Folder', '',
+            modified, 'false', '', '0', '', '', '', '']
+
+
+def write_native_row(csv_writer, row, future, key=None, cache=None, counts=None):
+    if future is not None:
+        try:
+            row[12] = future.result()
+            if cache is not None:
+                store_hash(cache, key, row[12], counts)
+        except OSError:
+            row[6] = 'Access denied'
+    csv_writer.writerow(row)
+
+
+# Walk path and write everything under it to csv_file like a DROID export, hashing the files on hash_threads threads.
+# The scanned folder gets ID 2 like in DROID's exports, the database loader names the project from that row.
+# Files found in the hash cache are not read. Returns the cache hit and miss counts.
+# Without recursive only the files and folders directly in path are written, the folders are not walked.
+def write_native_csv(path, csv_file, hash_threads, hash_cache=None, recursive=True):
+    next_id = 2
+    folders = [(path, '')]
+    pending = deque()
+    counts = {'hits': 0, 'misses': 0, 'stored': 0, 'disabled': False}
+    cache = None
+    if hash_cache is not None:
+        try:
+            cache = open_hash_cache(hash_cache)
+        except sqlite3.Error as e:
+            disable_hash_cache(e, counts)
+    # Windows leaves the device and inode out of the scandir stat
+    root_device = stat(path).st_dev
+    with open(csv_file, 'w', encoding='utf-8', newline='') as file, ThreadPoolExecutor(max_workers=hash_threads) as executor:
+        csv_writer = writer(file, quoting=QUOTE_ALL)
+        csv_writer.writerow(droid_csv_header)
+        while len(folders) > 0:
+            folder, parent_id = folders.pop()
+            folder_id = next_id
+            next_id += 1
+            try:
+                with scandir(folder) as entries:
+                    entries = sorted(entries, key=lambda entry: entry.name)
+                status = 'Done' if len(entries) > 0 else 'Empty'
+                modified = droid_timestamp(stat(folder).st_mtime)
+            except OSError:
+                entries = []
+                status = 'Access denied'
+                modified = ''
+            pending.append(([folder_id, parent_id, droid_uri(folder, True), folder, basename(folder), '', status, '', 'Folder', '',
+                             modified, 'false', '', '0', '', '', '', ''], None, None))
+
+            sub_folders = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            sub_folders.append((entry.path, folder_id))
+                        else:
+                            pending.append((native_folder_row(next_id, folder_id, entry), None, None))
+                            next_id += 1
+                        continue
+                    if not entry.is_file():
+                        continue
+                    info = entry.stat()
+                except OSError:
+                    continue
+                extension = splitext(entry.name)[1][1:].lower()
+                row = [next_id, folder_id, droid_uri(entry.path), entry.path, entry.name, '', 'Done', info.st_size, 'File',
+                       extension, droid_timestamp(info.st_mtime), 'false', '', '0', '', '', '', '']
+                next_id += 1
+                key = None
+                future = None
+                sha256 = None
+                if cache is not None:
+                    key = (info.st_dev or root_device, info.st_ino or entry.inode(), info.st_size, info.st_mtime_ns)
+                    sha256 = lookup_hash(cache, key, counts)
+                if sha256 is None:
+                    future = executor.submit(hash_file, entry.path)
+                else:
+                    row[12] = sha256
+                pending.append((row, future, key))
+                # Rows go out in ID order, only so many files are hashed ahead
+                while len(pending) > HASH_QUEUE_SIZE:
+                    write_native_row(csv_writer, *pending.popleft(), cache, counts)
+            folders += reversed(sub_folders)
+
+        while len(pending) > 0:
+            write_native_row(csv_writer, *pending.popleft(), cache, counts)
+    if cache is not None:
+        cache.close()
+    return counts['hits'], counts['misses']
+
+
+# Join DROID csv files into one, moving the IDs of every file past the ones before it. The root folder of a chunk
+# is already in the csv of the chunk above it, so that row is dropped and what is in it goes under the row already there.
+def merge_droid_csvs(csv_files, output_file):
+    offset = 0
+    folder_ids = {}
+    with open(output_file, 'w', encoding='utf-8', newline='') as file:
+        csv_writer = writer(file, quoting=QUOTE_ALL)
+        for x, csv_file in enumerate(csv_files):
+            max_id = offset
+            moved_ids = {}
+            with open(csv_file, 'r', encoding='utf-8', newline='') as f:
+                rows = reader(f)
+                header = next(rows)
+                if x == 0:
+                    csv_writer.writerow(header)
+                for row in rows:
+                    row_id = int(row[0]) + offset
+                    max_id = max(max_id, row_id)
+                    if row[1] == '' and row[3] in folder_ids:
+                        moved_ids[row[0]] = folder_ids[row[3]]
+                        continue
+                    row[0] = row_id
+                    if row[1] != '':
+                        row[1] = moved_ids.get(row[1], int(row[1]) + offset)
+                    if row[8] == 'Folder':
+                        folder_ids[row[3]] = row_id
+                    csv_writer.writerow(row)
+            offset = max_id
+
+
+def merge_csvs(journal, target, names):
+    output = journal['output']
+    if names == [target] or target in journal['merged']:
+        return
+    log.info(f'Merging {len(names)} CSV files into {target}.csv')
+    start_time = time()
+    merge_droid_csvs([join(output, name + '.csv') for name in names], join(output, target + '_working.csv'))
+    move(join(output, target + '_working.csv'), join(output, target + '.csv'))
+    write_metric(output, 'merge', target, time() - start_time, csv_files=len(names), bytes=stat(join(output, target + '.csv')).st_size)
+    journal['merged'].append(target)
+    write_journal(journal)
+    for name in names:
+        remove(join(output, name + '.csv'))
+
+
+# Join the csvs of a project's chunks into <project>.csv once all of them are done. Returns that csv, or None while
+# the project still has jobs to go.
+def merge_project_csv(journal, project):
+    names = [name for name, job in journal['jobs'].items() if job['project'] == project]
+    if any(journal['jobs'][name]['status'] != 'done' for name in names):
+        return None
+    merge_csvs(journal, project, names)
+    return join(journal['output'], project + '.csv')
+
+
+# Join the csvs of the jobs into one csv per project, and those into output.csv for S
+def merge_job_csvs(journal):
+    projects = list(dict.fromkeys(job['project'] for job in journal['jobs'].values()))
+    for project in projects:
+        merge_project_csv(journal, project)
+    if journal['csv_type'] == 'S':
+        merge_csvs(journal, 'output', projects)
+
+
+# Database Generation.py run in the database folder, loading every project csv handed to it on stdin as soon as
+# its scan is done. A restarted run carries on with the same database, and so does a run into a folder that already
+# has one: the loader refuses to start over next to an existing database.
+def start_loader(journal):
+    update = journal['database_started'] or any(name.startswith('ETC_Droid_DB_') for name in listdir(journal['database']))
+    if update and not journal['database_started']:
+        log.info(f'{journal["database"]} already has a database, the csv files are added to it')
+    journal['database_started'] = True
+    write_journal(journal)
+    log.info(f'Loading the csv files into the database in {journal["database"]} as they finish')
+    with open(join(journal['output'], 'database_log.txt'), 'a') as log_file:
+        # Its metrics go in with the ones of the scans
+        return Popen([executable, LOADER_LOCATION, '--stdin', '--metrics', abspath(join(journal['output'], METRICS_FILE))] + (['--update'] if update else []), cwd=journal['database'],
+                     stdin=PIPE, stdout=log_file, stderr=STDOUT, text=True)
+
+
+def send_to_loader(loader, csv_file):
+    if loader.poll() is not None:
+        log.error(f'The database loader exited with {loader.returncode}, {csv_file} is not loaded, see database_log.txt')
+        return
+    try:
+        loader.stdin.write(abspath(csv_file) + '\n')
+        loader.stdin.flush()
+    except BrokenPipeError:
+        log.error(f'The database loader stopped before {csv_file}, see database_log.txt')
+
+
+# Let the loader finish the files it has and index the database
+def finish_loader(loader, output):
+    wait_start = time()
+    try:
+        loader.stdin.close()
+    except BrokenPipeError:
+        pass
+    loader.wait()
+    write_metric(output, 'load_wait', 'database', time() - wait_start, status='done' if loader.returncode == 0 else 'failed')
+    if loader.returncode != 0:
+        log.error('Error while loading the database, see database_log.txt')
+        return False
+    log.info(f'Database ready {format_duration(time() - wait_start)} after the last scan')
+    return True
 
 
 def create_output_folder(output_dir):
@@ -89,141 +579,230 @@ def create_output_folder(output_dir):
     mkdir(output)
     return output
 
-def create_metadata_file(working_dir, output, blacklisted, level, gen_type):
-    # Generate a metadata file in the output for resume on crash
-    with open(join(output, 'metadata.txt'), 'w') as file:
-        file.write(working_dir + '\n')
-        file.write(output + '\n')
-        if len(blacklisted) > 0:
-            file.write(blacklisted[0])
-            for directory in blacklisted[1:]:
-                file.write(',' + directory)
-        file.write('\n')
-        file.write(level + '\n')
-        file.write(gen_type)
-
-
-def main(working_dir, output, blacklisted, csv_type, level, crashed):
-    log.info(f'Storing output in {output}')
+# The journal keeps the settings of a run and the state of every scan job in its output folder, for R to pick up from
+def create_journal(working_dir, output, blacklisted, level, csv_type, native, jobs, chunk_size, database=None):
+    scan_dirs = get_scan_dirs(working_dir, level, blacklisted)
+    if level == 'P': # Account for Project level working change
+        working_dir = dirname(normpath(working_dir))
+    journal = {
+        'working_dir': working_dir,
+        'output':      output,
+        'blacklisted': blacklisted,
+        'level':       level,
+        'csv_type':    csv_type,
+        'native':      native,
+        'finished':    False,
+        'merged':      [],
+        'database':    abspath(database) if database is not None else None,
+        'database_started': False,
+        'jobs':        plan_scan_jobs(working_dir, scan_dirs, jobs, chunk_size),
+    }
+    write_journal(journal)
+    return journal
+
+
+def read_journal(output):
+    with open(join(output, 'journal.json'), 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+# Written to the side and moved over the old one, a crash never leaves half a journal
+def write_journal(journal):
+    with journal_lock:
+        file = join(journal['output'], 'journal.json')
+        with open(file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(journal, f, indent=1)
+        replace(file + '.tmp', file)
+
+
+def set_job_status(journal, name, status, seconds=None):
+    with journal_lock:
+        journal['jobs'][name]['status'] = status
+        journal['jobs'][name]['seconds'] = seconds
+        write_journal(journal)
+
+
+# Remove whatever an unfinished job left behind before it runs again
+def clear_job_output(output, name):
+    for suffix in ['_working.droid', '.droid', '_working.csv', '.csv']:
+        if exists(join(output, name + suffix)):
+            remove(join(output, name + suffix))
+
+
+def run_scan_job(journal, name, env, hash_threads, hash_cache):
+    start_time = time()
+    output = journal['output']
+    job = journal['jobs'][name]
+    clear_job_output(output, name)
+    set_job_status(journal, name, 'running')
+    if journal['native']:
+        message = call_native_scan(output, name, job['path'], job['recursive'], (job['size'], job['files']), hash_threads, hash_cache)
+    else:
+        message = call_droid(output, name, job['path'], job['recursive'], (job['size'], job['files']), env)
+    status = 'failed' if message.startswith('Error') else 'done'
+    set_job_status(journal, name, status, round(time() - start_time))
+    write_metric(output, 'job', name, time() - start_time, project=job['project'], status=status, bytes=job['size'], files=job['files'])
+    return message
+
+
+def main(journal, jobs=DEFAULT_MAX_JOBS, job_memory=None, hash_threads=DEFAULT_HASH_THREADS, hash_cache=HASH_CACHE):
+    log.info(f'Storing output in {journal["output"]}')
     # Take stock of when we start
     start_time = time()
-    log.info(f'Started processing at {start_time}')
-    
-    if not crashed:
-        create_metadata_file(working_dir, output, blacklisted, level, csv_type)
-    
-    
-    pre_finished, scan_dirs = get_scan_dirs(working_dir, output, level, blacklisted)
-    
-    if level == 'P': # Account for Project level working change
-        working_dir = dirname(working_dir)
-
-    # Start the droid scanning of the dirs
-    if len(scan_dirs) > 0:
-        finished = 0
-        with ThreadPoolExecutor() as executor:
-            futures = []
-            for directory in scan_dirs:
-                futures.append(executor.submit(call_droid, output=output, working=working_dir, csv_type=csv_type, path=directory))
+    log.info(f'Started processing at {datetime.fromtimestamp(start_time)}')
+
+    # Only the jobs that have not finished yet, when restarting
+    scan_jobs = journal['jobs']
+    pending = [name for name, job in scan_jobs.items() if job['status'] != 'done']
+    pre_finished = len(scan_jobs) - len(pending)
+
+    # With a database the projects are loaded while the other scans go on, starting with the ones done before a restart
+    loader = None
+    if journal['database'] is not None:
+        loader = start_loader(journal)
+        for project in dict.fromkeys(job['project'] for job in scan_jobs.values()):
+            csv_file = merge_project_csv(journal, project)
+            if csv_file is not None:
+                send_to_loader(loader, csv_file)
+
+    # Start the scanning of the dirs, each thread waits on one droid process at a time
+    finished = 0
+    if len(pending) > 0:
+        pending.sort(key=lambda name: (scan_jobs[name]['size'], scan_jobs[name]['files']), reverse=True)
+        log.info(f'Scanning {len(pending)} directories with {jobs} jobs, largest first')
+        env = droid_environment(job_memory)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for name in pending:
+                futures[executor.submit(run_scan_job, journal, name, env, hash_threads, hash_cache)] = name
             for future in as_completed(futures):
                 if not future.result().startswith('Error'):
                     finished += 1
-                log.info(f'{future.result()} - {finished + pre_finished} / {len(scan_dirs) + pre_finished}')
+                    # The project csv is ready as soon as its last chunk is
+                    csv_file = merge_project_csv(journal, scan_jobs[futures[future]]['project'])
+                    if csv_file is not None and loader is not None:
+                        send_to_loader(loader, csv_file)
+                log.info(f'{future.result()} - {finished + pre_finished} / {len(scan_jobs)}')
     else:
         log.info('Already finished all droid scanning. Going to CSV generation.')
-    
-    if finished != len(scan_dirs):
+
+    loaded = finish_loader(loader, journal['output']) if loader is not None else True
+    if finished != len(pending):
         log.info('Encountered an error while running. Please fix the problem and rerun the program to try again.')
-        exit_program(start_time, 1)
+        exit_program(journal['output'], start_time, 1)
     else:
-        if csv_type == 'S':
-            # Call droid to generate the csv file from the resultant droid files
-            log.info('Generating CSV file')
-            process = Popen([DROID_LOCATION, '-p'] + [join(output, path + '.droid') for path in scan_dirs] + ['-e', join(output, 'output.csv')], stdout=PIPE, stderr=PIPE)
-            stdout, stderr = process.communicate()
-            
-            if stderr != b'':
-                log.error(f'{stderr}\nError while generating CSV file. Please fix problem and try again.')
-                remove(join(output, 'output.csv'))
-                exit_program(start_time, 1)
-            else:
-                log.info('Finished Generating CSV file successfully.')
-                remove(join(output, 'metadata.txt'))
-                exit_program(start_time, 0)
-        else:
-            exit_program(start_time, 0)
+        merge_job_csvs(journal)
+        log.info('Finished Generating CSV files successfully.')
+        journal['finished'] = True
+        write_journal(journal)
+        exit_program(journal['output'], start_time, 0 if loaded else 1)
 
-def exit_program(start_time, error_code):
+def exit_program(output, start_time, error_code):
     end_time = time()
-    log.info('Finished processing at {end_time}')
-    runtime = int(end_time-start_time)
-    hours = runtime / 3600
-    minutes = (runtime % 3600) / 60
-    seconds = (runtime % 3600) % 60
-    log.info(f'Processing took {hours}h {minutes}m {seconds}s.')
+    log.info(f'Finished processing at {datetime.fromtimestamp(end_time)}')
+    log.info(f'Processing took {format_duration(end_time - start_time)}.')
+    write_metric(output, 'run', basename(output), end_time - start_time, status='done' if error_code == 0 else 'failed')
+    log_metrics_summary(output)
     if error_code == 0:
         log.info('Exiting')
     else:
         log.error('Exiting with Error')
     quit(error_code)
 
-def call_droid(output, working, csv_type, path):
-    log.info(f'Started Scanning {path}')
-    profile = join(output, path + '_working.droid')
+# Scan path with droid into <name>.droid and export it to <name>.csv
+def call_droid(output, name, path, recursive=True, estimate=(0, 0), env=None):
+    start_time = time()
+    log.info(f'Started Scanning {name}')
+    profile = join(output, name + '_working.droid')
     log.info(f'Copying droid profile {profile}')
     copyfile(DROID_PROFILE, profile)
     # Call droid to populate that profile with the results
-    process = Popen([DROID_LOCATION, '-R', '-q', '-W', '-A', '-a', join(working, path.replace('.', '/')), '-p', profile], stdout=PIPE, stderr=PIPE)
+    process = Popen([DROID_LOCATION] + (['-R'] if recursive else []) + ['-q', '-W', '-A', '-a', path, '-p', profile], stdout=PIPE, stderr=PIPE, env=env)
     stdout, stderr = process.communicate()
-    # If we want individual csvs, then generate them here
-    if csv_type == 'M':
-        log.info(f'Generating CSV for {path}')
-        process = Popen([DROID_LOCATION, '-p', profile, '-e', join(output, path + '.csv')], stdout=PIPE, stderr=PIPE)
+    scan_time = time() - start_time
+    size, files = estimate
+    log.info(f'Scanned {name} in {format_duration(scan_time)} ({files / max(scan_time, 1):,.0f} files/s, {size / 1024 ** 2 / max(scan_time, 1):,.1f} MB/s)')
+    write_metric(output, 'droid_scan', name, scan_time, bytes=size, files=files, status='done' if stderr == b'' else 'failed')
+    if stderr == b'':
+        log.info(f'Generating CSV for {name}')
+        process = Popen([DROID_LOCATION, '-p', profile, '-e', join(output, name + '.csv')], stdout=PIPE, stderr=PIPE, env=env)
         stdout, stderr = process.communicate()
+        export_time = time() - start_time - scan_time
+        log.info(f'Generated CSV for {name} in {format_duration(export_time)}')
+        write_metric(output, 'droid_export', name, export_time, status='done' if stderr == b'' else 'failed')
     if stderr != b'':
         log.error(stderr.decode('utf-8'))
-        return "Error while Scanning " + path
+        return f"Error while Scanning {name} after {format_duration(time() - start_time)}"
     else:
         # After we have successfully run the code, move from working to normal
-        finished_profile = join(output, path + '.droid.')
-        move(profile, finished_profile)
-        return "Finished Scanning " + path
+        move(profile, join(output, name + '.droid'))
+        return f"Finished Scanning {name} in {format_duration(time() - start_time)}"
+
+# Scan path with the native scanner into <name>.csv, it is only given its final name once complete
+def call_native_scan(output, name, path, recursive=True, estimate=(0, 0), hash_threads=DEFAULT_HASH_THREADS, hash_cache=None):
+    start_time = time()
+    log.info(f'Started Scanning {name} natively')
+    working_csv = join(output, name + '_working.csv')
+    try:
+        hits, misses = write_native_csv(path, working_csv, hash_threads, hash_cache, recursive)
+    except OSError as e:
+        log.error(str(e))
+        return f"Error while Scanning {name} after {format_duration(time() - start_time)}"
+    move(working_csv, join(output, name + '.csv'))
+    scan_time = time() - start_time
+    size, files = estimate
+    log.info(f'Scanned {name} in {format_duration(scan_time)} ({files / max(scan_time, 1):,.0f} files/s, {size / 1024 ** 2 / max(scan_time, 1):,.1f} MB/s)')
+    if hash_cache is not None:
+        log.info(f'Hash cache for {name}: {hits:,} hits, {misses:,} misses')
+    write_metric(output, 'native_scan', name, scan_time, bytes=size, files=files, hash_hits=hits, hash_misses=misses)
+    return f"Finished Scanning {name} in {format_duration(scan_time)}"
 
 if __name__ == "__main__":
-    if len(argv) == 3 and argv[1] == 'R':
-        output_folder = argv[2]
+    args = argv[1:]
+    max_jobs = pop_option(args, '--max-jobs', DEFAULT_MAX_JOBS)
+    job_memory = pop_option(args, '--job-memory', None)
+    jobs = get_job_count(max_jobs, job_memory, pop_option(args, '--max-memory', None))
+    native = pop_flag(args, '--native')
+    hash_threads = pop_option(args, '--hash-threads', DEFAULT_HASH_THREADS)
+    hash_cache = pop_option(args, '--hash-cache', HASH_CACHE, str)
+    chunk_size = pop_option(args, '--chunk-gb', DEFAULT_CHUNK_GB, float) * 1024 ** 3
+    database = pop_option(args, '--database', None, str)
+
+    if len(args) in [1, 2] and args[0] == 'C':
+        days = int(args[1]) if len(args) == 2 else DEFAULT_HASH_CACHE_DAYS
+        before, after = compact_hash_cache(hash_cache, days)
+        print(f'Dropped {before - after:,} of {before:,} hashes not seen in {days} days from {hash_cache}.')
+        quit(0)
+
+    if len(args) == 2 and args[0] == 'R':
+        output_folder = args[1]
         found_folders = []
-        for folder in listdir(output_folder):
+        for folder in sorted(listdir(output_folder)):
             if folder.startswith('droid_output'):
                 found_folders.append(folder)
         if len(found_folders) > 0:
-            filename = join(output_folder, found_folders[-1], 'metadata.txt')
-            if exists(filename):
-                with open(filename, 'r') as file:
-                    working_dir = file.readline().strip()
-                    output = file.readline().strip()
-                    blacklisted = file.readline().split(',')
-                    level = file.readline()
-                    gen_type = file.readline()
-                    log.basicConfig(filename=f'{output}/log.txt', encoding='utf-8', level=log.INFO)
-                    main(working_dir, output, blacklisted, gen_type, level, True)
+            output = join(output_folder, found_folders[-1])
+            if exists(join(output, 'journal.json')) and not read_journal(output)['finished']:
+                log.basicConfig(filename=f'{output}/log.txt', encoding='utf-8', level=log.INFO)
+                main(read_journal(output), jobs, job_memory, hash_threads, hash_cache)
             else:
                 print('Last program did not crash.')
                 quit(1)
         else:
             print('No crashed programs found.')
             quit(1)
-        
+
     else:
-        if len(argv) < 4:
+        if len(args) < 4:
             print("Invalid Number of Arguments.")
             quit(1)
-        if argv[1] not in ['S', 'M']:
+        if args[0] not in ['S', 'M']:
             print('Invalid CSV Type Argument')
             quit(1)
-        if argv[2] not in ['T', 'S', 'P']:
+        if args[1] not in ['T', 'S', 'P']:
             print('Invalid Level Argument')
             quit(1)
-        output = create_output_folder(argv[4])
+        output = create_output_folder(args[3])
         log.basicConfig(filename=f'{output}/log.txt', encoding='utf-8', level=log.INFO)
-        main(argv[3], output, argv[5:], argv[1], argv[2], False)
\ No newline at end of file
+        journal = create_journal(args[2], output, args[4:], args[1], args[0], native, jobs, chunk_size, database)
+        main(journal, jobs, job_memory, hash_threads, hash_cache)
@@ -1,24 +1,30 @@
 # Do all imports for script. If this fails, you need to import more
-from os import listdir, remove
+from os import listdir, remove, stat
+from contextlib import closing
 import json
 from os.path import join, isfile, basename, exists, normpath, sep
-from csv import DictReader
+from csv import DictReader, reader
+from functools import lru_cache
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from sqlalchemy import create_engine
-from sqlalchemy import Table, Column, Integer, String, DateTime, Date, MetaData, ForeignKey
+from sqlalchemy import Table, Column, Integer, String, DateTime, Date, MetaData, ForeignKey, LargeBinary
 from sqlalchemy.sql import text
+from sqlalchemy.dialects import sqlite
+import sqlite3
 from time import time
 import regex as re
 import traceback
 from urllib.parse import unquote
+from multiprocessing import Process, Queue
+import argparse
+import sys
+import hashlib
+from array import array
+from query_plans import find_full_scans
+from droid_duplicates import build_duplicate_index, has_duplicate_index
 
-files = []
 root_folder = 'input'
-for filename in listdir(root_folder):
-    f = join(root_folder, filename)
-    if isfile(f):
-        files.append(f)
 
 droid_headers_id = ["id", "parent_id", "uri", "file_path", "filename", "id_method", "status", "size", "type", "file_extension", "last_modified", "ext_mis_warning", "hash", "file_format_count"]
 
@@ -48,30 +54,103 @@ key_to_header = {
     'format_version':     'file_format_version',
 }
 
+# Number of ID rows held in memory before they are flushed to the database
+BATCH_SIZE = 50000
+
+# Number of parsed batches a worker may queue ahead of the writer
+WORKER_QUEUE_SIZE = 4
+
+# Page cache given to SQLite in bulk mode, in KiB
+BULK_CACHE_KIB = 1024 * 1024
+
+# Directories resolve_project_path keeps the project state of
+RESOLVED_DIRS_SIZE = 4096
+
 path_regex = re.compile('[0-9]{4}[_-]semester[_-][123]|to-be-sorted-by-semester')
 
-def insert_data(table, values):
-    inserted = False
-    current_valid = 0
-    step = len(values)
-    stop = len(values)
-    while not inserted and step > 0:
-        try:
-            conn.execute(table, values[current_valid:min(stop, current_valid + step)])
-            current_valid += step
-            if current_valid >= stop:
-                inserted = True
-        except Exception as e:
-            if step == 1:
-                print(f"Failed on record #{current_valid}", values[current_valid:current_valid + step])
-                print(e)
-                step = 0
-                break
-            else:
-                print(f"Failed on step {step}. Quartering step and trying again.")
-                step = max(int(step / 4), 1)
+# Raw sqlite3 connection used instead of the SQLAlchemy one in bulk mode
+bulk_conn = None
+
+# Interned strings and directories of the compact schema, value -> id, and the new ones not written yet.
+# None unless the database uses the compact schema.
+compact_lookups = None
+compact_pending = None
+
+# Counters for the whole run, printed at the end
+run_stats = {
+    'retries':  0,
+    'rejected': 0,
+}
+
+# Metrics of every loaded file and phase, one JSON line each in metrics_file (--metrics), the same kind of lines
+# droid.py writes. run_metrics keeps them for the summary at the end.
+METRICS_FILE = 'ingest_metrics.jsonl'
+metrics_file = None
+run_metrics = []
+
+
+# Pick the columns of the table that the rows fill in, with the converter SQLAlchemy would use for each
+def raw_insert_columns(table, row):
+    dialect = sqlite.dialect()
+    columns = []
+    for column in table.columns:
+        if column.name in row:
+            columns.append((column.name, column.type.dialect_impl(dialect).bind_processor(dialect)))
+    return columns
+
+
+# Insert rows through executemany on the raw connection. The savepoint undoes a partial
+# executemany so a failed batch can be retried like it is on the SQLAlchemy path.
+def execute_raw_insert(table, values):
+    columns = raw_insert_columns(table, values[0])
+    statement = f'insert into {table.name} ({", ".join(name for name, _ in columns)}) values ({", ".join("?" for _ in columns)})'
+    bulk_conn.execute('savepoint batch')
+    try:
+        bulk_conn.executemany(statement, (tuple(row[name] if process is None else process(row[name]) for name, process in columns) for row in values))
+    except Exception:
+        bulk_conn.execute('rollback to batch')
+        raise
+    finally:
+        bulk_conn.execute('release batch')
+
+
+def execute_insert(table, values):
+    if bulk_conn is None:
+        conn.execute(table.insert(), values)
+    else:
+        execute_raw_insert(table, values)
+
+
+# Insert the rows, bisecting a failed batch down to the rows that cannot go in. Every attempt is
+# all or nothing, so rows that made it in are never sent again and a batch with k bad rows takes
+# O(k log n) attempts. Bad rows are kept in the rejected_rows table.
+def insert_data(table, values, source_file=''):
+    if len(values) == 0:
+        return
+    try:
+        execute_insert(table, values)
+    except Exception as e:
+        if len(values) == 1:
+            reject_row(table, values[0], source_file, e)
+            return
+        half = len(values) // 2
+        run_stats['retries'] += 2
+        insert_data(table, values[:half], source_file)
+        insert_data(table, values[half:], source_file)
+
+
+def reject_row(table, row, source_file, error):
+    reason = str(getattr(error, 'orig', None) or error)
+    print(f'\nRejected {table.name} row {row.get("id")} from {source_file}: {reason}')
+    run_stats['rejected'] += 1
+    execute_insert(rejected_rows, [{
+        'table_name':  table.name,
+        'source_file': source_file,
+        'row':         json.dumps(row, default=str),
+        'reason':      reason
+    }])
 
-def find_database():
+def find_database(update=False):
     names = []
     for file in listdir():
         if file.startswith('ETC_Droid_DB_'):
@@ -79,15 +158,20 @@ def find_database():
     if len(names) == 0:
         time = datetime.now()
         return f'ETC_Droid_DB_{time.strftime("%Y%m%d%H%M%S")}.db'
+    elif update:
+        return sorted(names)[-1]
     else:
-        raise Exception('Error. You have not moved/deleted the old database!!!')
+        raise Exception('Error. You have not moved/deleted the old database!!! Use --update to add to it instead.')
+
+def find_input_files(folder):
+    files = []
+    for filename in sorted(listdir(folder)):
+        f = join(folder, filename)
+        if isfile(f):
+            files.append(f)
+    return files
 
-# Create the sql engine
-handler = logging.FileHandler('sql.log')
-handler.setLevel(logging.DEBUG)
-logging.getLogger('sqlalchemy').addHandler(handler)
 
-engine = create_engine(f"sqlite:///{find_database()}", echo=False)
 metadata = MetaData()
 
 droid_ids = Table('droid_ids', metadata,
@@ -117,41 +201,549 @@ droid_formats = Table('droid_formats', metadata,
                       Column('file_format_name', String),
                       Column('file_format_version', String))
 
-metadata.create_all(engine)
-conn = engine.connect()
+# Compact schema (--compact). Repeated strings are interned in droid_strings, directories in droid_dirs,
+# file paths are stored as a directory plus the last segment, the uri is derived, hashes are binary and
+# timestamps are microseconds since the epoch. The droid_ids/droid_formats views put the original columns back.
+droid_strings = Table('droid_strings', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('value', String, unique=True))
 
-# Map the ID values into a new dict w/ parsed values
-def map_droid_dict_id_values(row):
-    row_dict = {}
-    for k, value in row.items():
-        if not k:
+droid_dirs = Table('droid_dirs', metadata,
+                   Column('id', Integer, primary_key=True),
+                   Column('value', String, unique=True))
+
+droid_ids_compact = Table('droid_ids_compact', metadata,
+                          Column('id', Integer, primary_key=True),
+                          Column('parent_id', Integer),
+                          Column('dir_id', Integer, ForeignKey('droid_dirs.id')),
+                          Column('name', String),
+                          Column('filename', String),
+                          Column('id_method_id', Integer, ForeignKey('droid_strings.id')),
+                          Column('status_id', Integer, ForeignKey('droid_strings.id')),
+                          Column('size', Integer),
+                          Column('type_id', Integer, ForeignKey('droid_strings.id')),
+                          Column('file_extension_id', Integer, ForeignKey('droid_strings.id')),
+                          Column('last_modified', Integer),
+                          Column('ext_mis_warning_id', Integer, ForeignKey('droid_strings.id')),
+                          Column('hash', LargeBinary),
+                          Column('file_format_count', Integer),
+                          Column('project_name_id', Integer, ForeignKey('droid_strings.id')),
+                          Column('project_year', Integer),
+                          Column('project_semester', Integer))
+
+droid_formats_compact = Table('droid_formats_compact', metadata,
+                              Column('id', Integer, primary_key=True),
+                              Column('file_id', Integer, ForeignKey('droid_ids_compact.id')),
+                              Column('pronom_id_id', Integer, ForeignKey('droid_strings.id')),
+                              Column('mime_type_id', Integer, ForeignKey('droid_strings.id')),
+                              Column('file_format_name_id', Integer, ForeignKey('droid_strings.id')),
+                              Column('file_format_version_id', Integer, ForeignKey('droid_strings.id')))
+
+# Columns of the droid tables that are interned in the compact schema
+compact_string_columns = ['id_method', 'status', 'type', 'file_extension', 'ext_mis_warning', 'project_name',
+                          'pronom_id', 'mime_type', 'file_format_name', 'file_format_version']
+
+# Views with the original columns so the notebooks run unchanged, deletes go through to the compact tables.
+# The strings are looked up in subqueries rather than joins: SQLite only runs the ones a query reads, so a query
+# that only needs indexed columns of the compact tables can be answered from their covering indexes.
+# They are recreated on every run, so an --update brings the views of an older compact database up to date.
+compact_views = [
+    'drop view if exists droid_ids',
+    '''create view droid_ids as
+       select droid_ids_compact.id, droid_ids_compact.parent_id,
+              'file:' || (select value from droid_dirs where droid_dirs.id = droid_ids_compact.dir_id) || '/' || droid_ids_compact.name as uri,
+              (select value from droid_dirs where droid_dirs.id = droid_ids_compact.dir_id) || '/' || droid_ids_compact.name as file_path,
+              coalesce(droid_ids_compact.filename, droid_ids_compact.name) as filename,
+              (select value from droid_strings where droid_strings.id = droid_ids_compact.id_method_id) as id_method,
+              (select value from droid_strings where droid_strings.id = droid_ids_compact.status_id) as status,
+              droid_ids_compact.size,
+              (select value from droid_strings where droid_strings.id = droid_ids_compact.type_id) as type,
+              (select value from droid_strings where droid_strings.id = droid_ids_compact.file_extension_id) as file_extension,
+              strftime('%Y-%m-%d %H:%M:%S', droid_ids_compact.last_modified / 1000000, 'unixepoch')
+                  || printf('.%06d', droid_ids_compact.last_modified % 1000000) as last_modified,
+              (select value from droid_strings where droid_strings.id = droid_ids_compact.ext_mis_warning_id) as ext_mis_warning,
+              case typeof(droid_ids_compact.hash) when 'blob' then lower(hex(droid_ids_compact.hash)) else droid_ids_compact.hash end as hash,
+              droid_ids_compact.file_format_count,
+              (select value from droid_strings where droid_strings.id = droid_ids_compact.project_name_id) as project_name,
+              droid_ids_compact.project_year, droid_ids_compact.project_semester
+       from droid_ids_compact''',
+    'drop view if exists droid_formats',
+    '''create view droid_formats as
+       select droid_formats_compact.id, droid_formats_compact.file_id,
+              (select value from droid_strings where droid_strings.id = droid_formats_compact.pronom_id_id) as pronom_id,
+              (select value from droid_strings where droid_strings.id = droid_formats_compact.mime_type_id) as mime_type,
+              (select value from droid_strings where droid_strings.id = droid_formats_compact.file_format_name_id) as file_format_name,
+              (select value from droid_strings where droid_strings.id = droid_formats_compact.file_format_version_id) as file_format_version
+       from droid_formats_compact''',
+    '''create trigger if not exists droid_ids_delete instead of delete on droid_ids
+       begin delete from droid_ids_compact where id = old.id; end''',
+    '''create trigger if not exists droid_formats_delete instead of delete on droid_formats
+       begin delete from droid_formats_compact where id = old.id; end''',
+]
+
+# One row per loaded csv file and the range of droid_ids it went into, so an update only loads new or changed files
+ingested_files = Table('ingested_files', metadata,
+                       Column('path', String, primary_key=True),
+                       Column('size', Integer),
+                       Column('mtime_ns', Integer),
+                       Column('sha256', String),
+                       Column('id_offset', Integer),
+                       Column('max_id', Integer),
+                       Column('format_end', Integer),
+                       Column('status', String),
+                       Column('ingested_at', DateTime))
+
+# Rollups of the droid tables for the publication queries, one set of rows per csv file.
+# rollup_formats has a row per format of a file like the droid_ids/droid_formats join does.
+rollup_formats = Table('rollup_formats', metadata,
+                       Column('source_file', String),
+                       Column('project_name', String),
+                       Column('type', String),
+                       Column('file_extension', String),
+                       Column('mime_type', String),
+                       Column('file_format_name', String),
+                       Column('file_format_version', String),
+                       Column('format_count', Integer),
+                       Column('size', Integer))
+
+# rollup_files has a row per file. identified is 1 if any of its formats has a name, unidentified if any has none.
+rollup_files = Table('rollup_files', metadata,
+                     Column('source_file', String),
+                     Column('project_name', String),
+                     Column('project_year', Integer),
+                     Column('project_semester', Integer),
+                     Column('type', String),
+                     Column('file_extension', String),
+                     Column('identified', Integer),
+                     Column('unidentified', Integer),
+                     Column('format_rows', Integer),
+                     Column('file_count', Integer),
+                     Column('size', Integer))
+
+# Nested set over the folders and files of every csv file, so the size, file count and formats under a folder are
+# a lookup instead of a recursive walk of parent_id. tree_left/tree_right are numbered from 2 * the file's id offset,
+# so the descendants of a node are the rows with tree_left between its tree_left and tree_right.
+# parent_id is the global id of the parent, the one in droid_ids is relative to its csv file.
+droid_tree = Table('droid_tree', metadata,
+                   Column('id', Integer, primary_key=True),
+                   Column('parent_id', Integer),
+                   Column('depth', Integer),
+                   Column('tree_left', Integer),
+                   Column('tree_right', Integer),
+                   Column('subtree_size', Integer),
+                   Column('subtree_files', Integer),
+                   Column('subtree_folders', Integer))
+
+# Format histogram of every folder: the format rows under it per format name, like rollup_formats counts them
+droid_tree_formats = Table('droid_tree_formats', metadata,
+                           Column('folder_id', Integer),
+                           Column('file_format_name', String),
+                           Column('file_count', Integer),
+                           Column('size', Integer))
+
+# Rows that could not be inserted, with the error they failed on
+rejected_rows = Table('rejected_rows', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('table_name', String),
+                      Column('source_file', String),
+                      Column('row', String),
+                      Column('reason', String))
+
+# Secondary indexes, only created once all of the data is in. Most of them cover the notebook queries
+# completely, query_plans.py checks that none of those queries falls back to a full table scan.
+droid_indexes = {
+    'ix_droid_ids_type_extension':  ('droid_ids', ['type', 'file_extension', 'size']),
+    'ix_droid_ids_type_status':     ('droid_ids', ['type', 'status']),
+    'ix_droid_ids_extension':       ('droid_ids', ['file_extension', 'type', 'file_format_count', 'size']),
+    'ix_droid_ids_hash':            ('droid_ids', ['hash', 'type', 'size']),
+    'ix_droid_ids_project':         ('droid_ids', ['project_name', 'project_year', 'project_semester', 'size']),
+    'ix_droid_formats_file_format': ('droid_formats', ['file_id', 'file_format_name', 'file_format_version']),
+    'ix_droid_formats_format_name': ('droid_formats', ['file_format_name', 'file_format_version']),
+    'ix_droid_formats_mime_type':   ('droid_formats', ['mime_type']),
+    'ix_droid_tree_parent':         ('droid_tree', ['parent_id', 'subtree_size']),
+    'ix_droid_tree_left':           ('droid_tree', ['tree_left', 'tree_right']),
+    'ix_droid_tree_formats_folder': ('droid_tree_formats', ['folder_id', 'file_format_name']),
+}
+
+
+# Run a statement with :named parameters on whichever connection is loading, returning any rows
+def execute_sql(statement, parameters=None):
+    parameters = parameters or {}
+    if bulk_conn is None:
+        result = conn.execute(text(statement), parameters)
+        return result.fetchall() if result.returns_rows else []
+    else:
+        return bulk_conn.execute(statement, parameters).fetchall()
+
+
+# Run a select on whichever connection is loading, yielding its rows as they are read instead of fetching them all
+def iter_sql(statement, parameters=None):
+    parameters = parameters or {}
+    if bulk_conn is None:
+        yield from conn.execute(text(statement), parameters)
+    else:
+        yield from bulk_conn.execute(statement, parameters)
+
+
+def create_indexes():
+    for name, (table, columns) in droid_indexes.items():
+        if compact_lookups is not None and table in ('droid_ids', 'droid_formats'):
+            table = f'{table}_compact'
+            columns = [f'{column}_id' if column in compact_string_columns else column for column in columns]
+        execute_sql(f'create index if not exists {name} on {table} ({", ".join(columns)})')
+    # Give the query planner the statistics to pick them
+    execute_sql('analyze')
+
+
+# Read the interned values back, so an update keeps using the same ids
+def load_compact_lookups():
+    global compact_lookups, compact_pending
+    compact_lookups, compact_pending = {}, {}
+    for table in (droid_strings, droid_dirs):
+        compact_lookups[table.name] = {value: id for id, value in execute_sql(f'select id, value from {table.name}')}
+        compact_pending[table.name] = []
+
+
+def intern_value(table, value):
+    if value is None:
+        return None
+    lookup = compact_lookups[table.name]
+    if value not in lookup:
+        lookup[value] = len(lookup) + 1
+        compact_pending[table.name].append({'id': lookup[value], 'value': value})
+    return lookup[value]
+
+
+def compact_id_row(row):
+    directory, _, name = row['file_path'].rpartition('/')
+    compact_row = {
+        'id':                row['id'],
+        'parent_id':         row.get('parent_id'),
+        'dir_id':            intern_value(droid_dirs, directory),
+        'name':              name,
+        'filename':          None if row.get('filename') == name else row.get('filename'),
+        'size':              row.get('size'),
+        'file_format_count': row.get('file_format_count'),
+        'project_year':      row['project_year'],
+        'project_semester':  row['project_semester'],
+    }
+    for key in compact_string_columns:
+        if key in row:
+            compact_row[f'{key}_id'] = intern_value(droid_strings, row[key])
+    if 'last_modified' in row:
+        compact_row['last_modified'] = (row['last_modified'] - datetime(1970, 1, 1)) // timedelta(microseconds=1)
+    if 'hash' in row:
+        try:
+            compact_row['hash'] = bytes.fromhex(row['hash'])
+        except ValueError:
+            compact_row['hash'] = row['hash']
+    return compact_row
+
+
+def compact_format_row(row):
+    compact_row = {'id': row['id'], 'file_id': row['file_id']}
+    for key in compact_string_columns:
+        if key in row:
+            compact_row[f'{key}_id'] = intern_value(droid_strings, row[key])
+    return compact_row
+
+
+# Insert a batch of offset rows into the droid tables, or into the compact tables and their lookups
+def write_batch(output_ids, output_formats, file):
+    if compact_lookups is None:
+        insert_data(droid_ids, output_ids, file)
+        insert_data(droid_formats, output_formats, file)
+    else:
+        compact_ids = [compact_id_row(row) for row in output_ids]
+        compact_formats = [compact_format_row(row) for row in output_formats]
+        for table in (droid_strings, droid_dirs):
+            insert_data(table, compact_pending[table.name], file)
+            compact_pending[table.name] = []
+        insert_data(droid_ids_compact, compact_ids, file)
+        insert_data(droid_formats_compact, compact_formats, file)
+
+
+# Size, mtime and content hash of a csv file
+def fingerprint_file(file):
+    file_stat = stat(file)
+    hasher = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return file_stat.st_size, file_stat.st_mtime_ns, hasher.hexdigest()
+
+
+# The ids the next file continues from, after every id range recorded in ingested_files. The ranges are used rather
+# than the rows, since rejected rows or a failed file leave the end of a range empty and an update deletes by range.
+# The max ids of the rows only count for databases loaded before the ranges were recorded.
+def current_offsets():
+    id_offset, format_end = execute_sql('select max(id_offset + max_id), max(format_end) from ingested_files')[0]
+    max_id = execute_sql('select max(id) from droid_ids')[0][0]
+    max_format_id = execute_sql('select max(id) from droid_formats')[0][0]
+    id_offset = max(id_offset or 0, max_id or 0)
+    format_end = max(format_end or 0, max_format_id + 1 if max_format_id is not None else 0)
+    return id_offset, format_end - id_offset
+
+
+# Drop the files that are already in the database unchanged, and the old rows of the ones that changed.
+# Returns the files to load and their fingerprints.
+def select_changed_files(csv_files):
+    changed_files, fingerprints = [], {}
+    for file in csv_files:
+        known = execute_sql('select size, mtime_ns, sha256, id_offset, max_id, status from ingested_files where path = :path', {'path': file})
+        file_stat = stat(file)
+        if known and known[0][5] == 'done' and (known[0][0], known[0][1]) == (file_stat.st_size, file_stat.st_mtime_ns):
             continue
-        key = key_to_header[k.lower()]
+
+        fingerprints[file] = fingerprint_file(file)
+        if known:
+            size, mtime_ns, sha256, id_offset, max_id, status = known[0]
+            if status == 'done' and sha256 == fingerprints[file][2]:
+                # Touched but not changed
+                execute_sql('update ingested_files set size = :size, mtime_ns = :mtime_ns where path = :path',
+                            {'size': fingerprints[file][0], 'mtime_ns': fingerprints[file][1], 'path': file})
+                continue
+            delete_file_rows(file, id_offset, max_id)
+        changed_files.append(file)
+    return changed_files, fingerprints
+
+
+def select_update_files(csv_files):
+    if bulk_conn is not None:
+        bulk_conn.execute('begin')
+    changed_files, fingerprints = select_changed_files(csv_files)
+    if bulk_conn is not None:
+        bulk_conn.execute('commit')
+    return changed_files, fingerprints
+
+
+# Remove the rows a csv file was loaded into
+def delete_file_rows(file, id_offset, max_id):
+    id_range = {'start': id_offset, 'end': id_offset + max_id}
+    execute_sql('delete from droid_formats where file_id > :start and file_id <= :end', id_range)
+    execute_sql('delete from droid_ids where id > :start and id <= :end', id_range)
+    execute_sql('delete from rejected_rows where source_file = :path', {'path': file})
+    execute_sql('delete from rollup_formats where source_file = :path', {'path': file})
+    execute_sql('delete from rollup_files where source_file = :path', {'path': file})
+    execute_sql('delete from droid_tree where id > :start and id <= :end', id_range)
+    execute_sql('delete from droid_tree_formats where folder_id > :start and folder_id <= :end', id_range)
+
+
+# Roll up the rows a csv file was just loaded into. Only the id ranges of the file are read,
+# and only what actually made it into the tables is counted.
+def build_rollups(file, id_offset, max_id, format_start, format_end):
+    ranges = {'path': file, 'start': id_offset, 'end': id_offset + max_id, 'format_start': format_start, 'format_end': format_end}
+    execute_sql('insert into rollup_formats (source_file, project_name, type, file_extension, mime_type, file_format_name, file_format_version, format_count, size) '
+                'select :path, project_name, type, file_extension, mime_type, file_format_name, file_format_version, count(), sum(size) '
+                'from droid_formats join droid_ids on droid_ids.id = droid_formats.file_id '
+                'where droid_formats.id >= :format_start and droid_formats.id < :format_end '
+                'group by project_name, type, file_extension, mime_type, file_format_name, file_format_version', ranges)
+    execute_sql('insert into rollup_files (source_file, project_name, project_year, project_semester, type, file_extension, identified, unidentified, format_rows, file_count, size) '
+                'select :path, project_name, project_year, project_semester, type, file_extension, coalesce(identified, 0), coalesce(unidentified, 0), coalesce(format_rows, 0), count(), sum(size) '
+                'from droid_ids left join ('
+                '    select file_id, max(file_format_name != \'\') as identified, max(file_format_name = \'\') as unidentified, count() as format_rows from droid_formats '
+                '    where id >= :format_start and id < :format_end group by file_id'
+                ') as formats on formats.file_id = droid_ids.id '
+                'where droid_ids.id > :start and droid_ids.id <= :end '
+                'group by project_name, project_year, project_semester, type, file_extension, identified, unidentified, format_rows', ranges)
+
+
+# Number the rows a csv file was just loaded into depth first, adding up the sizes, files, folders and formats
+# of every node's subtree on the way back up. Rows whose parent is not in the file are roots.
+# The rows are held in flat arrays indexed by the id relative to the file, only the nodes on the path being walked
+# have a format histogram, and the tree rows go out in batches, so memory stays small next to the file.
+def build_tree(id_offset, max_id, format_start, format_end, batch_size=BATCH_SIZE):
+    ranges = {'start': id_offset, 'end': id_offset + max_id, 'format_start': format_start, 'format_end': format_end}
+    # Relative parent id of every row, -1 for the ids that are not in the table
+    parents = array('q', [-1]) * (max_id + 1)
+    sizes = array('q', [0]) * (max_id + 1)
+    is_folder = bytearray(max_id + 1)
+    for id, parent_id, type, size in iter_sql('select id - :start, parent_id, type, size from droid_ids where id > :start and id <= :end', ranges):
+        parents[id] = parent_id or 0
+        sizes[id] = size or 0
+        is_folder[id] = type == 'Folder'
+
+    # The format rows of every file as (relative file id, format name index) pairs, then grouped by file id
+    format_names, format_indexes = [], {}
+    format_files, format_name_ids = array('q'), array('l')
+    for file_id, file_format_name in iter_sql('select file_id - :start, file_format_name from droid_formats where id >= :format_start and id < :format_end', ranges):
+        if file_format_name not in format_indexes:
+            format_indexes[file_format_name] = len(format_names)
+            format_names.append(file_format_name)
+        format_files.append(file_id)
+        format_name_ids.append(format_indexes[file_format_name])
+    file_formats_start, file_formats = group_by_index(format_files, format_name_ids, max_id + 1)
+    del format_files, format_name_ids
+
+    # Children of every node in id order, the same grouping over the parents
+    child_parents, child_ids, roots = array('q'), array('q'), array('q')
+    for id in range(1, max_id + 1):
+        parent = parents[id]
+        if parent < 0:
+            continue
+        if 0 < parent <= max_id and parent != id and parents[parent] >= 0:
+            child_parents.append(parent)
+            child_ids.append(id)
+        else:
+            roots.append(id)
+    children_start, children = group_by_index(child_parents, child_ids, max_id + 1)
+    del child_parents, child_ids
+
+    tree_rows, format_rows = [], []
+    counter = 2 * id_offset
+    tree_left = array('q', [0]) * (max_id + 1)
+    depths = array('l', [0]) * (max_id + 1)
+    subtree_sizes = array('q', [0]) * (max_id + 1)
+    subtree_files = array('q', [0]) * (max_id + 1)
+    subtree_folders = array('q', [0]) * (max_id + 1)
+    # Format name index -> [count, size] of the nodes being walked
+    histograms = {}
+    # Ids to enter, and ~id to leave
+    stack = array('q', reversed(roots))
+    while stack:
+        id = stack.pop()
+        if id >= 0:
+            tree_left[id] = counter
+            counter += 1
+            if is_folder[id]:
+                subtree_folders[id] = 1
+                histograms[id] = {}
+            else:
+                subtree_sizes[id] = sizes[id]
+                subtree_files[id] = 1
+                histogram = histograms[id] = {}
+                for x in range(file_formats_start[id], file_formats_start[id + 1]):
+                    histogram.setdefault(file_formats[x], [0, 0])
+                    histogram[file_formats[x]][0] += 1
+                    histogram[file_formats[x]][1] += sizes[id]
+            stack.append(~id)
+            for x in range(children_start[id + 1] - 1, children_start[id] - 1, -1):
+                depths[children[x]] = depths[id] + 1
+                stack.append(children[x])
+            continue
+
+        id = ~id
+        parent_id = parents[id] + id_offset if depths[id] > 0 else None
+        tree_rows.append({'id': id + id_offset, 'parent_id': parent_id, 'depth': depths[id], 'tree_left': tree_left[id], 'tree_right': counter,
+                          'subtree_size': subtree_sizes[id], 'subtree_files': subtree_files[id], 'subtree_folders': subtree_folders[id]})
+        counter += 1
+        histogram = histograms.pop(id)
+        if is_folder[id]:
+            for name_index, (file_count, format_size) in histogram.items():
+                format_rows.append({'folder_id': id + id_offset, 'file_format_name': format_names[name_index], 'file_count': file_count, 'size': format_size})
+        if depths[id] > 0:
+            parent = parents[id]
+            subtree_sizes[parent] += subtree_sizes[id]
+            subtree_files[parent] += subtree_files[id]
+            subtree_folders[parent] += subtree_folders[id]
+            parent_histogram = histograms[parent]
+            for name_index, (file_count, format_size) in histogram.items():
+                parent_histogram.setdefault(name_index, [0, 0])
+                parent_histogram[name_index][0] += file_count
+                parent_histogram[name_index][1] += format_size
+
+        if len(tree_rows) >= batch_size:
+            insert_data(droid_tree, tree_rows)
+            tree_rows = []
+        if len(format_rows) >= batch_size:
+            insert_data(droid_tree_formats, format_rows)
+            format_rows = []
+    insert_data(droid_tree, tree_rows)
+    insert_data(droid_tree_formats, format_rows)
+
+
+# Group values by their index in 0..count - 1 like a sort would, keeping their order within an index.
+# Returns starts and grouped, the values of index i are grouped[starts[i]:starts[i + 1]].
+def group_by_index(indexes, values, count):
+    starts = array('q', [0]) * (count + 1)
+    for index in indexes:
+        starts[index + 1] += 1
+    for x in range(count):
+        starts[x + 1] += starts[x]
+    grouped = array(values.typecode, [0]) * len(values)
+    filled = array('q', starts)
+    for index, value in zip(indexes, values):
+        grouped[filled[index]] = value
+        filled[index] += 1
+    return starts, grouped
+
+
+def record_ingested_file(file, fingerprint, id_offset, max_id, format_end, status):
+    size, mtime_ns, sha256 = fingerprint
+    execute_sql('insert or replace into ingested_files (path, size, mtime_ns, sha256, id_offset, max_id, format_end, status, ingested_at) '
+                'values (:path, :size, :mtime_ns, :sha256, :id_offset, :max_id, :format_end, :status, :ingested_at)',
+                {'path': file, 'size': size, 'mtime_ns': mtime_ns, 'sha256': sha256, 'id_offset': id_offset, 'max_id': max_id,
+                 'format_end': format_end, 'status': status, 'ingested_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')})
+
+
+# Whether the database has rows but no ingested_files manifest to say which csv files they came from, like one built
+# before --update existed. An update of it would load every csv in input/ again next to the rows already there.
+def has_unrecorded_rows(connection):
+    tables = {name for (name,) in connection.execute("select name from sqlite_master where type in ('table', 'view')")}
+    if 'droid_ids' not in tables:
+        return False
+    if 'ingested_files' in tables and connection.execute('select count() from ingested_files').fetchone()[0] > 0:
+        return False
+    return connection.execute('select exists (select 1 from droid_ids)').fetchone()[0] == 1
+
+
+# Connect with the loading profile. Nothing is synced until the end, so a crashed bulk run means a rebuild.
+def open_bulk_connection(database):
+    connection = sqlite3.connect(database, isolation_level=None)
+    connection.execute('pragma journal_mode = memory')
+    connection.execute('pragma synchronous = off')
+    connection.execute(f'pragma cache_size = -{BULK_CACHE_KIB}')
+    connection.execute('pragma temp_store = memory')
+    return connection
+
+
+def parse_droid_int(value):
+    return int(value) if value else 0
+
+
+# DROID always writes %Y-%m-%dT%H:%M:%S, so slice that directly and only fall back to strptime
+# for anything else. The same timestamps come up over and over in a project, so they are cached.
+@lru_cache(maxsize=65536)
+def parse_droid_timestamp(value):
+    if len(value) == 19 and value[4] == '-' and value[7] == '-' and value[10] == 'T' and value[13] == ':' and value[16] == ':' \
+            and (value[0:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:19]).isdigit():
+        return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]), int(value[14:16]), int(value[17:19]))
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def parse_droid_date(value):
+    return parse_droid_timestamp(value) if value else datetime.today()
+
+
+# Compile the header of a droid csv file once into the columns of the ID and Format rows.
+# Each plan is a list of (index, key, converter), converter is None for values that are kept as they are.
+def compile_column_plan(header):
+    id_plan, format_plan = [], []
+    for index, column in enumerate(header):
+        if not column:
+            continue
+        key = key_to_header[column.lower()]
 
         if key in droid_int_headers:
-            row_dict[key] = int(value) if value else 0
+            id_plan.append((index, key, parse_droid_int))
         elif key in droid_date_headers:
-            row_dict[key] = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S') if value else datetime.today()
+            id_plan.append((index, key, parse_droid_date))
         elif key in droid_headers_id:
-            row_dict[key] = value
-    return row_dict
+            id_plan.append((index, key, None))
 
+        if key == 'file_id':
+            format_plan.append((index, key, parse_droid_int))
+        elif key in droid_headers_format:
+            format_plan.append((index, key, None))
+    return id_plan, format_plan
 
-# Map the Format values into a new dict w/ parsed values
-def map_droid_dict_format_values(row):
-    new_row_dict_format = {}
-    for k, value in row.items():
-        if not k:
-            continue
-        key = key_to_header[k.lower()]
 
-        if key == 'id':
-            new_row_dict_format[key] = value
-        elif key == 'file_id':
-            new_row_dict_format[key] = int(value) if value else 0
-        elif key in droid_headers_format:
-            new_row_dict_format[key] = value
-    return new_row_dict_format
+# Map a csv row into a new dict w/ parsed values following a column plan
+def map_droid_row(row, plan):
+    row_dict = {}
+    for index, key, converter in plan:
+        row_dict[key] = row[index] if converter is None else converter(row[index])
+    return row_dict
 
 
 def parsepath(path):
@@ -161,21 +753,16 @@ def parsepath(path):
     return path
 
 
-def parseprojectpath(path):
-    path = parsepath(path)
-    path = path.split('/')
-    while len(path) > 0 and not path_regex.fullmatch(path[0]):
-        path = path[1:]
-    return '/' + '/'.join(path)
-
 def parsefoldername(path):
     path = parsepath(path)
     return basename(path)
 
 
-# Create the project name to project file name dict_link
+# Read the project listing into a trie of its paths from the semester folder down, {segment: {segment: ...}} with the
+# project under the None key of the node its folder ends on, and the folder name -> project dict for the projects
+# whose listed path has no semester folder or has moved to another one.
 def parse_project_listing_csv(input_file):
-    parsed_names = {}
+    project_trie, parsed_names = {}, {}
     with open(input_file, 'r', encoding='utf-8') as file:
         dict_reader = DictReader(file)
         for row in dict_reader:
@@ -185,21 +772,71 @@ def parse_project_listing_csv(input_file):
             project_semester = row['Semester']
             if project_path == "":
                 continue
-            folder_name = parsefoldername(project_path)
-            parsed_names[folder_name] = project_name, project_year, project_semester
-    return parsed_names
+            project = project_name, project_year, project_semester
+            parsed_names[parsefoldername(project_path)] = project
 
+            segments = parsepath(project_path).split('/')
+            start = next((x for x, segment in enumerate(segments) if path_regex.fullmatch(segment)), None)
+            if start is not None:
+                node = project_trie
+                for segment in segments[start:]:
+                    node = node.setdefault(segment, {})
+                node[None] = project
+    return project_trie, parsed_names
 
-project_name_by_folder_name = parse_project_listing_csv('ETC_Past_Projects_Listing.csv')
 
-
-# Parse project name from file path
-def parse_project_name(file_path):
-    folder_name = basename(file_path)
+def project_by_folder_name(folder_name):
     if folder_name in project_name_by_folder_name:
         return project_name_by_folder_name[folder_name]
-    else:
-        return f'Unverified Name: {folder_name}', '', ''
+    return f'Unverified Name: {folder_name}', '', ''
+
+
+# Where a path stands after its first segments: (relative path from the semester folder or None before it, trie node
+# reached or None once off the listing, deepest listed project passed, project folder name or None above it)
+def step_project_path(state, segment):
+    relative, node, project, folder = state
+    if relative is None:
+        if path_regex.fullmatch(segment):
+            return '/' + segment, project_trie.get(segment), None, None
+        return state
+    if node is not None:
+        node = node.get(segment)
+        if node is not None and None in node:
+            project = node[None]
+    return relative + '/' + segment, node, project, folder or segment
+
+
+# Resolve a droid path to its project and its path from the semester folder, one step past its parent directory.
+# Paths above the project folder or without a semester folder get None for the project, and keep '/' as their path
+# like the old parseprojectpath did.
+def resolve_project_path(path):
+    parent, _, name = parsepath(path).rpartition('/')
+    relative, _, project, folder = step_project_path(resolve_project_dir(parent), name)
+    if project is None and folder is not None:
+        project = project_by_folder_name(folder)
+    return project, relative or '/'
+
+
+# The state of a directory, from the state of its own parent. The rows of a csv file come folder by folder, so only
+# the recently seen directories are kept and most rows cost one cache lookup.
+@lru_cache(maxsize=RESOLVED_DIRS_SIZE)
+def resolve_project_dir(directory):
+    if '/' not in directory:
+        return step_project_path((None, None, None, None), directory)
+    parent, _, name = directory.rpartition('/')
+    return step_project_path(resolve_project_dir(parent), name)
+
+
+# Projects the listing does not have, with their files, for the whole database at once. It runs at the very end,
+# after --parquet has closed the loading connection, so it reads through a connection of its own.
+def print_unverified_projects(database):
+    connection = sqlite3.connect(database)
+    unverified = connection.execute("select project_name, sum(file_count) from rollup_files where project_name like 'Unverified Name: %' "
+                                    "group by project_name order by project_name").fetchall()
+    connection.close()
+    if unverified:
+        print(f'{len(unverified):,} project folders are not in ETC_Past_Projects_Listing.csv:')
+        print('\n'.join(f'  {name[len("Unverified Name: "):]} ({files:,} rows)' for name, files in unverified))
 
 
 def get_time(start_time, end_time):
@@ -210,115 +847,366 @@ def get_time(start_time, end_time):
     return f'{hours:2d}h {minutes:2d}m {seconds:2d}s'
 
 
-def print_progress(stime, progress, pmax, end_message=None, erase=False, step=25):
-    if erase:
-        print('\r[', end='', flush=True)
-    else:
-        print('[', end='', flush=True)
-    for x in range(int(progress / pmax * step)):
-        print('=', end='', flush=True)
-    for x in range(step - int(progress / pmax * step)):
-        print(' ', end='', flush=True)
+def print_phase(name, rows, start_time, end_time):
+    rate = rows / max(end_time - start_time, 0.001)
+    print(f'{name}: {rows:,} rows in {get_time(start_time, end_time)} ({rate:,.0f} rows/sec)')
+
+
+# Redraw the progress bar in one write, with the rows loaded so far and their rate
+def print_progress(stime, progress, pmax, end_message=None, erase=False, step=25, rows=0):
+    done = int(progress / pmax * step)
+    bar = ('\r[' if erase else '[') + '=' * done + ' ' * (step - done)
     if end_message is None:
-        print('] {0:3d}% {1}'.format(int(progress / pmax * 100), get_time(stime, time())), end='', flush=True)
+        rate = rows / max(time() - stime, 0.001)
+        print(f'{bar}] {int(progress / pmax * 100):3d}% {get_time(stime, time())} {rows:,} rows ({rate:,.0f} rows/sec)   ', end='', flush=True)
     else:
-        print(f'] {end_message}', flush=True)
+        print(f'{bar}] {end_message}', flush=True)
+
+
+def write_metric(stage, name, seconds, **values):
+    record = {'time': datetime.now().isoformat(timespec='seconds'), 'tool': 'Database Generation.py', 'stage': stage, 'name': name, 'seconds': round(seconds, 3)}
+    record.update(values)
+    run_metrics.append(record)
+    if metrics_file is not None:
+        with open(metrics_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+# Where the time of the run went: parsing, inserting, rollups and tree over all files, the phases after the load,
+# and the files with the lowest rows/sec
+def print_metrics_summary(top=5):
+    loads = [record for record in run_metrics if record['stage'] == 'load']
+    if loads:
+        total = sum(record['seconds'] for record in loads)
+        print(f'Load time per stage over {len(loads)} files:')
+        for part in ('parse_seconds', 'insert_seconds', 'rollup_seconds', 'tree_seconds'):
+            seconds = sum(record[part] for record in loads)
+            print(f'  {part[:-len("_seconds")]:<10} {seconds:>10,.1f}s ({seconds / max(total, 0.001):.0%})')
+    for record in run_metrics:
+        if record['stage'] != 'load':
+            print(f'  {record["stage"]:<10} {record["seconds"]:>10,.1f}s')
+    if len(loads) > 1:
+        print('Slowest files:')
+        for record in sorted(loads, key=lambda record: record['rows_per_sec'])[:top]:
+            print(f'  {record["name"]}: {record["rows"]:,} rows in {record["seconds"]:,.1f}s ({record["rows_per_sec"]:,} rows/sec, '
+                  f'parse {record["parse_seconds"]:.1f}s, insert {record["insert_seconds"]:.1f}s, {record["retries"]} retries)')
+
+
+# Read a droid csv file row by row, yielding the mapped ID row and its Format rows.
+# IDs are left relative to the file, offsetting is done by the caller.
+def iter_droid_rows(file):
+    with open(file, 'r', encoding='utf-8') as f:
+        csv_reader = reader(f)
+        header = next(csv_reader, None)
+        if header is None:
+            return
+        id_plan, format_plan = compile_column_plan(header)
+        uri_index, file_path_index = header.index('URI'), header.index('FILE_PATH')
+        columns = len(header)
+
+        resolve_project_dir.cache_clear()
+        # For rows that do not say which project they are in, the project of the scanned folder (ID 2)
+        file_project = None
+        for row in csv_reader:
+            if not row:
+                continue
+            # Short rows are padded like DictReader does, anything past the header are extra formats
+            if len(row) < columns:
+                row += [None] * (columns - len(row))
+            if row[uri_index].endswith('./'):
+                continue
+            if row[file_path_index] == '':
+                uri = row[uri_index]
+                row[file_path_index] = unquote(uri[uri.index('file://') + len('file://'):])
+            try:
+                row_id = map_droid_row(row, id_plan)
+                row_format = map_droid_row(row, format_plan)
 
+                project, relative_path = resolve_project_path(row_id['file_path'])
+                if file_project is None or row_id['id'] == 2:
+                    file_project = project or project_by_folder_name(parsefoldername(row_id['file_path']))
+                row_id['project_name'], row_id['project_year'], row_id['project_semester'] = project or file_project
 
-# Create arrays of the ID and Format rows
-def insert_dict_list(csv_files):
+                row_id['file_path'] = relative_path
+                row_id['uri'] = 'file:' + row_id['file_path']
+
+                row_formats = [row_format]
+                extra = row[columns:]
+                for x in range(0, len(extra), 4):
+                    row_formats.append({
+                        'pronom_id':           extra[x],
+                        'mime_type':           extra[x + 1],
+                        'file_format_name':    extra[x + 2],
+                        'file_format_version': extra[x + 3]
+                    })
+                row_id['format_count'] = len(row_formats)
+            except Exception as e:
+                raise Exception(f'\nFailed on row {row}\n{traceback.format_exc()}')
+            yield row_id, row_formats
+
+
+# Group the rows of a droid csv file into batches of at most batch_size ID rows.
+# Format rows carry the file relative ID of their file in file_id, their own id is set by the writer.
+def iter_droid_batches(file, batch_size):
+    output_ids, output_formats = [], []
+    try:
+        for row_id, row_formats in iter_droid_rows(file):
+            for row_format in row_formats:
+                row_format['file_id'] = row_id['id']
+            output_ids.append(row_id)
+            output_formats += row_formats
+            if len(output_ids) >= batch_size:
+                yield output_ids, output_formats
+                output_ids, output_formats = [], []
+    except Exception:
+        # Hand over what was read before the failure, like the serial loader always did
+        if output_ids:
+            yield output_ids, output_formats
+        raise
+    if output_ids:
+        yield output_ids, output_formats
+
+
+# Parse the given files in a worker process and queue their batches for the writer.
+# Every file ends with None, or with the traceback string if it failed.
+def parse_worker(csv_files, queue, batch_size, project_listing):
+    global project_trie, project_name_by_folder_name
+    project_trie, project_name_by_folder_name = project_listing
+    for file in csv_files:
+        try:
+            for batch in iter_droid_batches(file, batch_size):
+                queue.put(batch)
+            queue.put(None)
+        except Exception:
+            queue.put(traceback.format_exc())
+
+
+# Read the batches of one file back from a worker queue
+def iter_queued_batches(queue):
+    while True:
+        message = queue.get()
+        if message is None:
+            return
+        if isinstance(message, str):
+            raise Exception(message)
+        yield message
+
+
+# Read off what is left of a file's batches up to its end or traceback marker, so the next file read from the
+# same queue starts at its own first batch
+def drain_queued_batches(batches):
+    try:
+        for _ in batches:
+            pass
+    except Exception:
+        pass
+
+
+# Stream the ID and Format rows of every file into the tables, flushing every batch_size rows.
+# With more than one worker the files are parsed in worker processes while this process writes
+# them in order, so the IDs come out the same as with a serial run.
+def insert_dict_list(csv_files, batch_size=BATCH_SIZE, workers=1, fingerprints=None):
     progress = 0
-    count = 0
-    format_id = 0
+    count, format_id = current_offsets()
+    row_total = 0
+    fingerprints = fingerprints or {}
 
     file_count = len(csv_files)
     start_time = time()
+    if file_count == 0:
+        print('No csv files to load.')
+        return row_total
 
-    print_progress(start_time, progress, file_count)
+    # Files are dealt out round robin so the writer can read file x from queue x % workers
+    workers = max(min(workers, file_count), 1)
+    queues, processes = [], []
+    if workers > 1:
+        for worker in range(workers):
+            queue = Queue(WORKER_QUEUE_SIZE)
+            process = Process(target=parse_worker, args=(csv_files[worker::workers], queue, batch_size, (project_trie, project_name_by_folder_name)), daemon=True)
+            process.start()
+            queues.append(queue)
+            processes.append(process)
 
-    file_step = max(int(file_count / 4), 1)
-    for x in range(0, file_count, file_step):
-        for file in csv_files[x:x + file_step]:
-            output_ids, output_formats = [], []
+    print_progress(start_time, progress, file_count, rows=row_total)
 
-            # Try to get data
-            try:
-                with open(file, 'r', encoding='utf-8') as f:
-                    dict_reader = DictReader(f)
-
-                    project_name = ''
-                    max_id = 0
-                    for row in dict_reader:
-                        if row['URI'].endswith('./'):
-                            continue
-                        if row['FILE_PATH'] == '':
-                            uri = row['URI']
-                            row['FILE_PATH'] = unquote(uri[uri.index('file://') + len('file://'):])
-                        try:
-                            row_id = map_droid_dict_id_values(row)
-                            row_format = map_droid_dict_format_values(row)
-
-                            if row_id['id'] == 2:
-                                project_name, project_year, project_semester = parse_project_name(row_id['file_path'])
-
-                            max_id = max(row_id['id'], max_id)
-
-                            row_id['id'] += count
-                            row_id['project_name'] = project_name
-                            row_id['project_year'] = project_year
-                            row_id['project_semester'] = project_semester
-
-                            row_id['file_path'] = parseprojectpath(row_id['file_path'])
-                            row_id['uri'] = 'file:' + row_id['file_path']
-
-                            row_format['id'] = format_id + count
-                            row_format['file_id'] = row_id['id']
-                            format_id += 1
-
-                            output_formats.append(row_format)
-
-                            format_count = 1
-                            if None in row:
-                                extra = row[None]
-                                for x in range(0, len(extra), 4):
-                                    temp_row_format = {
-                                        'id':                  format_id + count,
-                                        'file_id':             row_id['id'],
-                                        'pronom_id':           extra[x],
-                                        'mime_type':           extra[x + 1],
-                                        'file_format_name':    extra[x + 2],
-                                        'file_format_version': extra[x + 3]
-                                    }
-                                    output_formats.append(temp_row_format)
-                                    format_id += 1
-                                    format_count += 1
-                            row_id['format_count'] = format_count
-                            output_ids.append(row_id)
-                        except Exception as e:
-                            print_progress(None, progress, file_count, erase=True, end_message='Failed!')
-                            raise Exception(f'\nFailed on row {row}\n{traceback.format_exc()}')
-                    count += max_id
-            except Exception as e:
-                print_progress(None, progress, file_count, erase=True, end_message='Failed!')
-                print(f'\nFailed on project {file}!\n{traceback.format_exc()}')
-
-            # Try to insert the current data progress
-            ins_ids = droid_ids.insert()
-            ins_formats = droid_formats.insert()
-
-            # Droid_Ids
-            insert_data(ins_ids, output_ids)
-            # Droid_Formats
-            insert_data(ins_formats, output_formats)
-
-            del output_ids
-            del output_formats
-            progress += 1
-            print_progress(start_time, progress, file_count, erase=True)
+    for x, file in enumerate(csv_files):
+        if workers > 1:
+            batches = iter_queued_batches(queues[x % workers])
+        else:
+            batches = iter_droid_batches(file, batch_size)
+
+        # In bulk mode every file goes in as one transaction
+        if bulk_conn is not None:
+            bulk_conn.execute('begin')
+
+        # Try to get data, offsetting it into the global ids and inserting it as the batches come in
+        max_id = 0
+        status = 'done'
+        format_start = format_id + count
+        # Everything but the inserts is counted as parsing: reading and mapping the rows, or waiting on the workers
+        file_start = time()
+        insert_seconds = 0
+        file_rows = 0
+        retries, rejected = run_stats['retries'], run_stats['rejected']
+        try:
+            for output_ids, output_formats in batches:
+                for row_id in output_ids:
+                    max_id = max(row_id['id'], max_id)
+                    row_id['id'] += count
+                for row_format in output_formats:
+                    row_format['id'] = format_id + count
+                    row_format['file_id'] += count
+                    format_id += 1
+
+                insert_start = time()
+                write_batch(output_ids, output_formats, file)
+                insert_seconds += time() - insert_start
+                file_rows += len(output_ids) + len(output_formats)
+                print_progress(start_time, progress, file_count, erase=True, rows=row_total + file_rows)
+        except Exception as e:
+            status = 'failed'
+            print_progress(None, progress, file_count, erase=True, end_message='Failed!')
+            print(f'\nFailed on project {file}!\n{traceback.format_exc()}')
+            if workers > 1:
+                drain_queued_batches(batches)
+
+        parse_seconds = time() - file_start - insert_seconds
+        rollup_start = time()
+        build_rollups(file, count, max_id, format_start, format_id + count)
+        tree_start = time()
+        build_tree(count, max_id, format_start, format_id + count, batch_size)
+        tree_seconds = time() - tree_start
+
+        # Failed files keep their id range too, so their partial rows can be replaced by a later update
+        if file not in fingerprints:
+            fingerprints[file] = fingerprint_file(file)
+        record_ingested_file(file, fingerprints[file], count, max_id, format_id + count, status)
+        count += max_id
+
+        if bulk_conn is not None:
+            bulk_conn.execute('commit')
+
+        file_seconds = time() - file_start
+        row_total += file_rows
+        write_metric('load', file, file_seconds, status=status, rows=file_rows, rows_per_sec=round(file_rows / max(file_seconds, 0.001)),
+                     parse_seconds=round(parse_seconds, 3), insert_seconds=round(insert_seconds, 3),
+                     rollup_seconds=round(tree_start - rollup_start, 3), tree_seconds=round(tree_seconds, 3),
+                     retries=run_stats['retries'] - retries, rejected=run_stats['rejected'] - rejected)
+
+        progress += 1
+        print_progress(start_time, progress, file_count, erase=True, rows=row_total)
+
+    for process in processes:
+        process.join()
     print_progress(None, progress, file_count, erase=True, end_message='Complete!')
     print(f'Processing took {get_time(start_time, time())}.')
+    return row_total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f'Build the ETC droid database from the droid csv files in {root_folder}/.')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes parsing csv files (default: 1, parse in the writer)')
+    parser.add_argument('--bulk', action='store_true', help='load through raw executemany with a loading PRAGMA profile and one transaction per file')
+    parser.add_argument('--update', action='store_true', help='add new or changed csv files to the newest existing database instead of building a new one')
+    parser.add_argument('--parquet', nargs='?', const='', metavar='DIR', help='also export the tables as a parquet dataset partitioned by project year/semester (default DIR: <database>_parquet)')
+    parser.add_argument('--compact', action='store_true', help='store the rows in the compact schema with interned strings and paths, behind droid_ids/droid_formats views')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help=f'rows held in memory per insert (default: {BATCH_SIZE})')
+    parser.add_argument('--duplicates', action='store_true', help='build the duplicate content index over the hashes (droid_duplicates.py), rebuilt after every later load once it exists')
+    parser.add_argument('--stdin', action='store_true', help=f'load the csv files named on standard input, one path per line, as they come in instead of {root_folder}/ (used by droid.py --database)')
+    parser.add_argument('--metrics', default=METRICS_FILE, metavar='FILE', help=f'JSON lines file the per file and per phase metrics are appended to (default: {METRICS_FILE})')
+    args = parser.parse_args()
+    metrics_file = args.metrics
+
+    files = [] if args.stdin else find_input_files(root_folder)
+
+    # Create the sql engine
+    handler = logging.FileHandler('sql.log')
+    handler.setLevel(logging.DEBUG)
+    logging.getLogger('sqlalchemy').addHandler(handler)
+
+    database = find_database(args.update)
+
+    # An update keeps the schema the database was built with
+    compact = args.compact
+    if exists(database):
+        with closing(sqlite3.connect(database)) as connection:
+            compact = connection.execute("select type from sqlite_master where name = 'droid_ids'").fetchone() == ('view',)
+            if has_unrecorded_rows(connection):
+                raise Exception(f'Error. {database} has no record of the csv files it was loaded from, so --update would load them all again. Rebuild it instead.')
+
+    engine = create_engine(f"sqlite:///{database}", echo=False)
+    if compact:
+        skipped_tables = [droid_ids, droid_formats]
+    else:
+        skipped_tables = [droid_strings, droid_dirs, droid_ids_compact, droid_formats_compact]
+    metadata.create_all(engine, tables=[table for table in metadata.sorted_tables if table not in skipped_tables])
+    if args.bulk:
+        bulk_conn = open_bulk_connection(database)
+    else:
+        conn = engine.connect()
+    if compact:
+        for statement in compact_views:
+            execute_sql(statement)
+        load_compact_lookups()
+
+    project_trie, project_name_by_folder_name = parse_project_listing_csv('ETC_Past_Projects_Listing.csv')
+
+    # Only load what is new or changed since the last run
+    fingerprints = {}
+    if args.update and not args.stdin:
+        files, fingerprints = select_update_files(files)
+        print(f'Updating {database} with {len(files)} new or changed csv files.')
+
+    # Insert the data into the tables
+    load_start = time()
+    if args.stdin:
+        # Each file goes in as soon as droid.py has finished it, the ids carry on from the rows already loaded
+        row_total = 0
+        for line in sys.stdin:
+            files = [line.strip()]
+            fingerprints = {}
+            if args.update:
+                files, fingerprints = select_update_files(files)
+            row_total += insert_dict_list(files, args.batch_size, args.workers, fingerprints)
+    else:
+        row_total = insert_dict_list(files, args.batch_size, args.workers, fingerprints)
+    load_end = time()
+
+    # Index the data now that it is all in
+    create_indexes()
+    index_end = time()
+
+    print_phase('Load', row_total, load_start, load_end)
+    print_phase('Index', row_total, load_end, index_end)
+    write_metric('index', database, index_end - load_end, rows=row_total)
+
+    # Columnar copy for the analyses, pyarrow is only needed when asked for
+    if args.parquet is not None:
+        from droid_columnar import export_columnar
+        if bulk_conn is not None:
+            bulk_conn.close()
+        else:
+            conn.close()
+        parquet_dir = args.parquet or database[:-len('.db')] + '_parquet'
+        export_columnar(database, parquet_dir)
+        print_phase('Parquet export', row_total, index_end, time())
+        write_metric('parquet', parquet_dir, time() - index_end, rows=row_total)
+        print(f'Parquet dataset written to {parquet_dir}')
+
+    # The duplicate index covers the whole database, so once there is one it is rebuilt after every load
+    if args.duplicates or has_duplicate_index(sqlite3.connect(database)):
+        duplicates_start = time()
+        hash_count = build_duplicate_index(database)
+        print_phase('Duplicate index', row_total, duplicates_start, time())
+        write_metric('duplicates', database, time() - duplicates_start, hashes=hash_count)
+        print(f'{hash_count:,} duplicated hashes, run droid_duplicates.py for the report.')
+    print(f'Batch retries: {run_stats["retries"]:,}, rejected rows: {run_stats["rejected"]:,}')
+    print_unverified_projects(database)
 
-# Insert the data into the tables
-insert_dict_list(files)
+    # Make sure the notebook queries still have an index to use
+    for name, detail in find_full_scans(sqlite3.connect(database)):
+        print(f'Warning: query "{name}" does a full scan: {detail}')
 
-del project_name_by_folder_name
\ No newline at end of file
+    print_metrics_summary()
+    print(f'Metrics written to {metrics_file}')
@@ -0,0 +1,125 @@
+# Ingest benchmark of Database Generation.py on synthetic DROID exports (see droid_synthetic.py).
+# Builds a corpus of every size in a temporary folder, runs the loader on it in its own process and records
+# throughput, peak RSS and database size in benchmark_results.jsonl, comparing each run to the last one
+# recorded with the same settings so regressions in insert_dict_list/insert_data stand out.
+#
+# Usage:
+#   python benchmark_ingest.py [--sizes 10000 1000000 10000000] [--files 4] [--dir TMP] [--loader-args="--bulk --workers 2"]
+from datetime import datetime
+from os import listdir
+from os.path import join, dirname, abspath, getsize
+from runpy import run_path
+from shlex import split, join as join_args
+from subprocess import run, PIPE, STDOUT
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import argparse
+import json
+import sqlite3
+import sys
+import regex as re
+
+from droid_synthetic import write_droid_corpus
+
+script_folder = dirname(abspath(__file__))
+loader_script = join(script_folder, 'Database Generation.py')
+
+# A drop in rows/sec bigger than this against the last recorded run is reported as a regression
+REGRESSION_THRESHOLD = 0.10
+
+
+# Runs in the benchmark's child process: the loader itself, then its peak RSS in KiB (bytes on macOS)
+def run_loader(loader_args):
+    sys.argv = [loader_script] + loader_args
+    sys.path.insert(0, script_folder)
+    run_path(loader_script, run_name='__main__')
+    try:
+        import resource
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    except ImportError:
+        peak_rss = None
+    print(f'Peak RSS: {peak_rss}')
+
+
+def git_commit():
+    result = run(['git', 'rev-parse', '--short', 'HEAD'], cwd=script_folder, stdout=PIPE, stderr=PIPE, text=True)
+    return result.stdout.strip() if result.returncode == 0 else ''
+
+
+def benchmark_size(rows, files, loader_args, temp_dir):
+    with TemporaryDirectory(dir=temp_dir) as folder:
+        start = perf_counter()
+        write_droid_corpus(folder, rows, files)
+        generate_seconds = perf_counter() - start
+
+        start = perf_counter()
+        result = run([sys.executable, abspath(__file__), '--child', '--loader-args=' + join_args(loader_args)],
+                     cwd=folder, stdout=PIPE, stderr=STDOUT, text=True)
+        seconds = perf_counter() - start
+        if result.returncode != 0:
+            print(result.stdout)
+            raise Exception(f'The loader failed on {rows:,} rows.')
+
+        database = join(folder, [file for file in listdir(folder) if file.startswith('ETC_Droid_DB_')][0])
+        loaded_rows = sqlite3.connect(database).execute('select count() from droid_ids').fetchone()[0]
+        load_rate = re.search(r'^Load: .*\(([\d,]+) rows/sec\)', result.stdout, re.M)
+        peak_rss = re.search(r'^Peak RSS: (\d+)', result.stdout, re.M)
+        return {
+            'date':             datetime.now().isoformat(timespec='seconds'),
+            'commit':           git_commit(),
+            'rows':             rows,
+            'files':            files,
+            'loader_args':      join_args(loader_args),
+            'loaded_rows':      loaded_rows,
+            'generate_seconds': round(generate_seconds, 2),
+            'seconds':          round(seconds, 2),
+            'rows_per_sec':     round(loaded_rows / seconds),
+            'load_rows_per_sec': int(load_rate.group(1).replace(',', '')) if load_rate else None,
+            'peak_rss_mib':     round(int(peak_rss.group(1)) / 1024, 1) if peak_rss else None,
+            'db_size_mib':      round(getsize(database) / 1024 ** 2, 1),
+        }
+
+
+def last_result(results_file, record):
+    last = None
+    try:
+        with open(results_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                old = json.loads(line)
+                if (old['rows'], old['files'], old['loader_args']) == (record['rows'], record['files'], record['loader_args']):
+                    last = old
+    except FileNotFoundError:
+        pass
+    return last
+
+
+def print_record(record, last):
+    print(f'{record["rows"]:>12,} rows: {record["rows_per_sec"]:>9,} rows/sec overall, {record["load_rows_per_sec"] or 0:>9,} rows/sec load, '
+          f'{record["seconds"]:>8.1f}s, peak RSS {record["peak_rss_mib"]} MiB, database {record["db_size_mib"]:,} MiB')
+    if last is None:
+        return
+    change = record['rows_per_sec'] / last['rows_per_sec'] - 1
+    print(f'{"":>18}{change:+.1%} rows/sec against {last["date"]} ({last["commit"] or "unknown commit"})')
+    if change < -REGRESSION_THRESHOLD:
+        print(f'{"":>18}Regression: throughput dropped more than {REGRESSION_THRESHOLD:.0%}!')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Database Generation.py on synthetic DROID csv files.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 1000000, 10000000], help='rows per benchmark run (default: 10k, 1M and 10M)')
+    parser.add_argument('--files', type=int, default=4, help='csv files the rows are spread over (default: 4)')
+    parser.add_argument('--loader-args', default='', help='arguments passed on to Database Generation.py, e.g. "--bulk --workers 2"')
+    parser.add_argument('--dir', default=None, help='folder for the temporary corpora and databases, 10M rows take about 8 GB')
+    parser.add_argument('--results', default=join(script_folder, 'benchmark_results.jsonl'), help='file the results are appended to')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_loader(split(args.loader_args))
+        quit()
+
+    for rows in args.sizes:
+        record = benchmark_size(rows, args.files, split(args.loader_args), args.dir)
+        print_record(record, last_result(args.results, record))
+        with open(args.results, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
@@ -0,0 +1,48 @@
+# Micro-benchmark of the csv row mapping in Database Generation.py.
+# Compares the per-cell DictReader mapping and path parsing the loader used to do (droid_legacy.py) with the compiled
+# column plans and the project trie, on a synthetic DROID csv, and checks that both produce the same rows.
+#
+# Usage:
+#   python benchmark_mapping.py [rows]
+from importlib.util import spec_from_file_location, module_from_spec
+from os.path import join, dirname, abspath
+from sys import argv
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import droid_legacy
+from droid_synthetic import write_droid_csv
+
+spec = spec_from_file_location('database_generation', join(dirname(abspath(__file__)), 'Database Generation.py'))
+generation = module_from_spec(spec)
+spec.loader.exec_module(generation)
+generation.project_trie, generation.project_name_by_folder_name = {'2017_semester_1': {'wfk': {None: ('WFK', '2017', '1')}}}, {'wfk': ('WFK', '2017', '1')}
+
+
+# The old mapping from droid_legacy.py, as the baseline
+def legacy_iter_droid_rows(file):
+    return droid_legacy.iter_droid_rows(file, generation.project_name_by_folder_name)
+
+
+def time_rows(iter_rows, file):
+    start = perf_counter()
+    rows = list(iter_rows(file))
+    return rows, len(rows) / (perf_counter() - start)
+
+
+if __name__ == '__main__':
+    row_count = int(argv[1]) if len(argv) > 1 else 200000
+    with TemporaryDirectory() as folder:
+        file = join(folder, 'synthetic.csv')
+        write_droid_csv(file, '2017_semester_1', 'wfk', row_count, row_count)
+
+        before_rows, before = time_rows(legacy_iter_droid_rows, file)
+        after_rows, after = time_rows(generation.iter_droid_rows, file)
+
+    print(f'Rows:   {len(after_rows):,}')
+    print(f'Before: {before:,.0f} rows/sec (DictReader, per-cell lookups, strptime)')
+    print(f'After:  {after:,.0f} rows/sec (csv.reader, compiled column plan, cached timestamps, project trie)')
+    print(f'Speedup: {after / before:.2f}x')
+    if before_rows != after_rows:
+        print('Mismatch: the two mappings produced different rows!')
+        quit(1)
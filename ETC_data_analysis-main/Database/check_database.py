@@ -0,0 +1,185 @@
+# Consistency checks of a droid database against slower ways of getting the same answer:
+#   tree      droid_tree and droid_tree_formats of sampled folders against recursive queries over parent_id
+#   frames    the group-bys of droid_frames.py against the same aggregates in SQL
+#   projects  the file paths and projects of the loaded csv files against the parseprojectpath and ID 2 project
+#             parsing the loader used to do before the project trie (droid_legacy.py)
+# Run it in the folder the database was loaded in, the projects check reads the csv files and listing from there.
+# Prints every mismatch and exits with 1 if there is any.
+#
+# Usage:
+#   python check_database.py [database] [--checks tree frames projects] [--sample 20]
+from collections import Counter
+from csv import DictReader
+from os import listdir
+from os.path import exists
+import argparse
+import sqlite3
+
+import droid_legacy
+from droid_frames import format_distribution, size_per_format, files_per_project
+from droid_queries import named_queries, run_query
+
+# Every row under a folder, by walking the parent ids of its csv file in check_children
+subtree_cte = '''with recursive subtree(id) as (
+                     select :folder_id
+                     union all
+                     select check_children.id from check_children join subtree on check_children.parent_id = subtree.id)'''
+
+# droid_ids has no index on parent_id, which is relative to the csv file, so the walk goes through a temp copy
+# of one file's (parent id, id) pairs indexed on the parent
+check_children_statements = [
+    'drop table if exists temp.check_children',
+    'create temp table check_children as select parent_id + :start as parent_id, id from droid_ids where id > :start and id <= :end',
+    'create index temp.ix_check_children_parent on check_children (parent_id, id)',
+]
+
+
+# Compare the tree of sample random folders of every loaded file with what walking parent_id gives.
+# Returns (folder id, what differs) for every mismatch and the number of folders checked.
+def find_tree_mismatches(connection, sample=20):
+    mismatches, checked = [], 0
+    for id_offset, max_id in connection.execute('select id_offset, max_id from ingested_files order by id_offset').fetchall():
+        ranges = {'start': id_offset, 'end': id_offset + max_id}
+        for statement in check_children_statements:
+            connection.execute(statement, ranges)
+        folders = connection.execute("select id from droid_ids where type = 'Folder' and id > :start and id <= :end order by random() limit :sample",
+                                     dict(ranges, sample=sample)).fetchall()
+        for (folder_id,) in folders:
+            parameters = dict(ranges, folder_id=folder_id)
+            checked += 1
+            walked = connection.execute(f"{subtree_cte} select coalesce(sum(case when type != 'Folder' then size end), 0), "
+                                        f"count(case when type != 'Folder' then 1 end), count(case when type = 'Folder' then 1 end) "
+                                        f"from droid_ids where id in subtree", parameters).fetchone()
+            tree = connection.execute('select subtree_size, subtree_files, subtree_folders, tree_left, tree_right from droid_tree where id = :folder_id',
+                                      parameters).fetchone()
+            if tree is None:
+                mismatches.append((folder_id, 'no droid_tree row'))
+                continue
+            if tuple(walked) != tuple(tree[:3]):
+                mismatches.append((folder_id, f'size, files, folders {tuple(tree[:3])} in droid_tree, {tuple(walked)} walking parent_id'))
+
+            # The nested set range has to hold exactly the walked rows
+            nested = connection.execute('select count() from droid_tree where tree_left >= :left and tree_right <= :right',
+                                        {'left': tree[3], 'right': tree[4]}).fetchone()[0]
+            if nested != walked[1] + walked[2]:
+                mismatches.append((folder_id, f'{nested:,} rows in its tree_left/tree_right range, {walked[1] + walked[2]:,} walking parent_id'))
+
+            walked_formats = set(connection.execute(f"{subtree_cte} select file_format_name, count(), coalesce(sum(size), 0) from droid_formats "
+                                                    f"join droid_ids on droid_ids.id = droid_formats.file_id "
+                                                    f"where droid_formats.file_id in subtree and type != 'Folder' group by file_format_name",
+                                                    parameters).fetchall())
+            tree_formats = set(connection.execute('select file_format_name, file_count, size from droid_tree_formats where folder_id = :folder_id',
+                                                  parameters).fetchall())
+            if walked_formats != tree_formats:
+                mismatches.append((folder_id, f'format histogram {sorted(tree_formats)} in droid_tree_formats, {sorted(walked_formats)} walking parent_id'))
+    return mismatches, checked
+
+
+# Compare every group of the droid_frames analyses with the SQL aggregate it stands in for.
+# Returns (analysis, group, frames value, SQL value) for every mismatch and the number of groups compared.
+def find_frame_mismatches(database, connection):
+    # Every group, not only the top ones
+    limit = connection.execute('select count() from droid_formats').fetchone()[0] + 1
+    analyses = [
+        ('format_distribution', format_distribution(database, limit).to_dict(),
+         {tuple(row[:3]): row[3] for row in run_query(database, named_queries['extension_format_counts'][0], False, limit=limit)}),
+        ('size_per_format', size_per_format(database, limit).to_dict(),
+         {tuple(row[:2]): row[2] for row in run_query(database, named_queries['format_sizes'][0], False, limit=limit)}),
+        ('files_per_project', {name: tuple(totals) for name, totals in files_per_project(database, limit).iterrows()},
+         {row[0]: tuple(row[1:]) for row in connection.execute("select project_name, count(), coalesce(sum(size), 0) from droid_ids "
+                                                               "where type != 'Folder' group by project_name")}),
+    ]
+
+    mismatches, compared = [], 0
+    for analysis, frames_values, sql_values in analyses:
+        for group in frames_values.keys() | sql_values.keys():
+            compared += 1
+            frames_value, sql_value = frames_values.get(group), sql_values.get(group)
+            # The GB sums are rounded to 2 decimals on both sides, from float sums added up in a different order
+            if isinstance(frames_value, float) and isinstance(sql_value, float):
+                equal = abs(frames_value - sql_value) < 0.011
+            else:
+                equal = frames_value == sql_value
+            if not equal:
+                mismatches.append((analysis, group, frames_value, sql_value))
+    return mismatches, compared
+
+
+# Compare the file path and project of every row of the loaded csv files with what the old parsing makes of the csv.
+# The old parsing gave every row the project of the scanned folder (ID 2), so projects are only compared in files
+# that scan one project folder, whose name is listed once and that has no other project listed below it.
+# Returns (csv file, id, what differs) for every mismatch, the number of rows compared and the csv files not found.
+def find_project_mismatches(connection, listing_file='ETC_Past_Projects_Listing.csv'):
+    project_name_by_folder_name = droid_legacy.parse_project_listing_csv(listing_file)
+    with open(listing_file, 'r', encoding='utf-8') as file:
+        listed_paths = [row['Parent File Path'] for row in DictReader(file) if row['Parent File Path']]
+    listed_names = Counter(droid_legacy.parsefoldername(listed_path) for listed_path in listed_paths)
+    # From the semester folder down, the rows under a listed path get that project from the trie
+    listed_paths = [droid_legacy.parseprojectpath(listed_path) for listed_path in listed_paths]
+
+    mismatches, compared, missing = [], 0, []
+    for path, id_offset in connection.execute('select path, id_offset from ingested_files order by id_offset').fetchall():
+        if not exists(path):
+            missing.append(path)
+            continue
+        project_mismatches, scanned_path = [], None
+        for row_id, _ in droid_legacy.iter_droid_rows(path, project_name_by_folder_name):
+            if row_id['id'] == 2:
+                scanned_path = row_id['file_path']
+            loaded = connection.execute('select file_path, project_name, project_year, project_semester from droid_ids where id = :id',
+                                        {'id': id_offset + row_id['id']}).fetchone()
+            # Rejected rows are not in the database
+            if loaded is None:
+                continue
+            compared += 1
+            if loaded[0] != row_id['file_path']:
+                mismatches.append((path, row_id['id'], f"path {loaded[0]!r} loaded, {row_id['file_path']!r} parsing the old way"))
+            # Year and semester are stored as integers
+            legacy_project = row_id['project_name'], str(row_id['project_year']), str(row_id['project_semester'])
+            loaded_project = loaded[1], str(loaded[2]), str(loaded[3])
+            if loaded_project != legacy_project:
+                project_mismatches.append((path, row_id['id'], f'project {loaded_project} loaded, {legacy_project} parsing the old way'))
+
+        segments = (scanned_path or '').split('/')
+        if len(segments) == 3 and listed_names[segments[2]] <= 1 and not any(listed_path.startswith(scanned_path + '/') for listed_path in listed_paths):
+            mismatches.extend(project_mismatches)
+    return mismatches, compared, missing
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check a droid database against slower ways of getting the same answer.')
+    parser.add_argument('database', nargs='?', help='database to check (default: the newest ETC_Droid_DB_*.db here)')
+    parser.add_argument('--checks', nargs='+', choices=['tree', 'frames', 'projects'], default=['tree', 'frames', 'projects'], help='checks to run (default: all of them)')
+    parser.add_argument('--sample', type=int, default=20, help='folders per csv file the tree check walks (default: 20)')
+    parser.add_argument('--listing', default='ETC_Past_Projects_Listing.csv', help='project listing the database was loaded with')
+    args = parser.parse_args()
+
+    database = args.database or sorted(file for file in listdir() if file.startswith('ETC_Droid_DB_') and file.endswith('.db'))[-1]
+    connection = sqlite3.connect(database)
+    connection.execute('pragma temp_store = memory')
+    failed = False
+
+    if 'tree' in args.checks:
+        mismatches, checked = find_tree_mismatches(connection, args.sample)
+        for folder_id, detail in mismatches:
+            print(f'Tree mismatch in folder {folder_id}: {detail}')
+        print(f'Tree: {checked - len({folder_id for folder_id, _ in mismatches}):,} / {checked:,} folders match walking parent_id.')
+        failed = failed or len(mismatches) > 0
+
+    if 'frames' in args.checks:
+        mismatches, compared = find_frame_mismatches(database, connection)
+        for analysis, group, frames_value, sql_value in mismatches:
+            print(f'Frames mismatch in {analysis} {group}: {frames_value} in the frames, {sql_value} in SQL')
+        print(f'Frames: {compared - len(mismatches):,} / {compared:,} groups match SQL.')
+        failed = failed or len(mismatches) > 0
+
+    if 'projects' in args.checks:
+        mismatches, compared, missing = find_project_mismatches(connection, args.listing)
+        for path in missing:
+            print(f'Projects: {path} not found, not checked')
+        for path, id, detail in mismatches:
+            print(f'Projects mismatch in {path} ID {id}: {detail}')
+        print(f'Projects: {compared - len({(path, id) for path, id, _ in mismatches}):,} / {compared:,} rows match the old parsing.')
+        failed = failed or len(mismatches) > 0
+
+    quit(1 if failed else 0)
@@ -0,0 +1,103 @@
+# Columnar (Parquet) copy of the droid tables, partitioned by project year and semester
+import sqlite3
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# Rows fetched from SQLite per record batch
+EXPORT_CHUNK_ROWS = 500000
+
+partition_schema = pa.schema([
+    ('project_year',     pa.int32()),
+    ('project_semester', pa.int32()),
+])
+
+# Low cardinality string columns are dictionary encoded, in the files and in memory once read
+dictionary_string = pa.dictionary(pa.int32(), pa.string())
+
+droid_ids_schema = pa.schema([
+    ('id',                pa.int64()),
+    ('parent_id',         pa.int64()),
+    ('uri',               pa.string()),
+    ('file_path',         pa.string()),
+    ('filename',          pa.string()),
+    ('id_method',         dictionary_string),
+    ('status',            dictionary_string),
+    ('size',              pa.int64()),
+    ('type',              dictionary_string),
+    ('file_extension',    dictionary_string),
+    ('last_modified',     pa.timestamp('us')),
+    ('ext_mis_warning',   dictionary_string),
+    ('hash',              pa.string()),
+    ('file_format_count', pa.int32()),
+    ('project_name',      dictionary_string),
+    ('project_year',      pa.int32()),
+    ('project_semester',  pa.int32()),
+])
+
+# Formats carry the partition columns of their file so they can be pruned the same way
+droid_formats_schema = pa.schema([
+    ('id',                  pa.int64()),
+    ('file_id',             pa.int64()),
+    ('pronom_id',           dictionary_string),
+    ('mime_type',           dictionary_string),
+    ('file_format_name',    dictionary_string),
+    ('file_format_version', dictionary_string),
+    ('project_year',        pa.int32()),
+    ('project_semester',    pa.int32()),
+])
+
+# Unverified projects have '' for year and semester, those end up in the null partition
+export_queries = {
+    'droid_ids': (droid_ids_schema,
+                  'select id, parent_id, uri, file_path, filename, id_method, status, size, type, file_extension, '
+                  'last_modified, ext_mis_warning, hash, file_format_count, project_name, '
+                  'nullif(project_year, \'\'), nullif(project_semester, \'\') from droid_ids order by id'),
+    'droid_formats': (droid_formats_schema,
+                      'select droid_formats.id, file_id, pronom_id, mime_type, file_format_name, file_format_version, '
+                      'nullif(project_year, \'\'), nullif(project_semester, \'\') from droid_formats '
+                      'left join droid_ids on droid_ids.id = droid_formats.file_id order by droid_formats.id'),
+}
+
+
+def to_arrow(values, data_type):
+    if pa.types.is_dictionary(data_type):
+        return pa.array(values, pa.string()).dictionary_encode()
+    if pa.types.is_timestamp(data_type):
+        # SQLite keeps the timestamps as text
+        return pa.array(values, pa.string()).cast(data_type)
+    return pa.array(values, data_type)
+
+
+def iter_record_batches(connection, query, schema):
+    cursor = connection.execute(query)
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+        if not rows:
+            return
+        columns = zip(*rows)
+        yield pa.RecordBatch.from_arrays([to_arrow(list(values), field.type) for values, field in zip(columns, schema)], schema=schema)
+
+
+# Write droid_ids and droid_formats of the database as hive partitioned parquet datasets under output_dir
+def export_columnar(database, output_dir):
+    # The batches are pulled from pyarrow's writer thread
+    connection = sqlite3.connect(database, check_same_thread=False)
+    try:
+        for table, (schema, query) in export_queries.items():
+            ds.write_dataset(iter_record_batches(connection, query, schema), f'{output_dir}/{table}', schema=schema,
+                             format='parquet', partitioning=ds.partitioning(partition_schema, flavor='hive'),
+                             existing_data_behavior='delete_matching')
+    finally:
+        connection.close()
+
+
+# Read only the given columns of a table from the partitions that match years/semesters.
+# filter is an optional extra pyarrow.dataset expression, e.g. ds.field('type') == 'File'.
+def read_columnar(dataset_dir, table, columns=None, years=None, semesters=None, filter=None):
+    dataset = ds.dataset(f'{dataset_dir}/{table}', format='parquet', partitioning=ds.partitioning(partition_schema, flavor='hive'))
+    expression = filter
+    for column, values in (('project_year', years), ('project_semester', semesters)):
+        if values is not None:
+            match = ds.field(column).isin(list(values))
+            expression = match if expression is None else expression & match
+    return dataset.to_table(columns=columns, filter=expression)
@@ -0,0 +1,152 @@
+# Duplicate content index over the hash column of droid_ids: which files share their content, between which
+# projects and semesters, and how many bytes keeping one copy of each would save.
+#
+# The index is built once after a load (Database Generation.py --duplicates, or this script with --build) so the
+# report only reads the small tables below instead of self-joining the 9M rows of droid_ids:
+#   duplicate_hashes            one row per hash held by more than one file, with its size and spread
+#   duplicate_files             hash -> file id, project and semester of every file holding a duplicated hash
+#   duplicate_project_overlap   hashes and bytes every pair of projects has in common
+#   duplicate_semester_overlap  the same per pair of semesters, a semester paired with itself being the
+#                               content shared between different projects of that semester
+#
+# Usage:
+#   python droid_duplicates.py [database] [--build] [--limit 20]
+from os import listdir
+from time import time
+import argparse
+import sqlite3
+
+from droid_queries import output_as_markdown_table, format_number
+
+duplicate_tables = ['duplicate_hashes', 'duplicate_files', 'duplicate_project_overlap', 'duplicate_semester_overlap']
+
+# Files, not folders, with a hash. Files DROID could not hash have '' and are left out.
+duplicate_index_statements = [
+    # Grouped on the (hash, type, size) index, no rows of droid_ids are read
+    '''create table duplicate_hashes as
+       select hash, max(size) as size, count() as file_count, 0 as project_count, 0 as semester_count,
+              (count() - 1) * max(size) as saved_bytes
+       from droid_ids where hash != '' and type != 'Folder' group by hash having count() > 1''',
+    'create unique index ix_duplicate_hashes_hash on duplicate_hashes (hash)',
+    # Only the files of the duplicated hashes are looked up
+    '''create table duplicate_files as
+       select duplicate_hashes.hash, droid_ids.id as file_id, droid_ids.size, droid_ids.project_name,
+              droid_ids.project_year, droid_ids.project_semester
+       from duplicate_hashes join droid_ids on droid_ids.hash = duplicate_hashes.hash
+       where droid_ids.type != 'Folder' ''',
+    'create index ix_duplicate_files_hash on duplicate_files (hash, project_name)',
+    'create index ix_duplicate_files_file_id on duplicate_files (file_id)',
+    # Every project and semester a hash shows up in once, for the spread and the overlap pairs
+    '''create temp table duplicate_projects as
+       select hash, project_name, project_year, project_semester, max(size) as size, count() as file_count
+       from duplicate_files group by hash, project_name, project_year, project_semester''',
+    'create index temp.ix_duplicate_projects_hash on duplicate_projects (hash, project_name)',
+    '''update duplicate_hashes set
+           project_count = (select count(distinct project_name) from duplicate_projects where duplicate_projects.hash = duplicate_hashes.hash),
+           semester_count = (select count(distinct project_year || '_' || project_semester) from duplicate_projects where duplicate_projects.hash = duplicate_hashes.hash)''',
+    '''create table duplicate_project_overlap as
+       select a.project_name as project_a, b.project_name as project_b, count() as shared_hashes, sum(a.size) as shared_bytes
+       from duplicate_projects as a join duplicate_projects as b on a.hash = b.hash and a.project_name < b.project_name
+       group by a.project_name, b.project_name''',
+    '''create table duplicate_semester_overlap as
+       select year_a, semester_a, year_b, semester_b, count() as shared_hashes, sum(size) as shared_bytes from (
+           select distinct a.hash, a.size, a.project_year as year_a, a.project_semester as semester_a,
+                  b.project_year as year_b, b.project_semester as semester_b
+           from duplicate_projects as a join duplicate_projects as b on a.hash = b.hash and a.project_name < b.project_name
+           where (a.project_year, a.project_semester) <= (b.project_year, b.project_semester)
+           union
+           select distinct a.hash, a.size, b.project_year, b.project_semester, a.project_year, a.project_semester
+           from duplicate_projects as a join duplicate_projects as b on a.hash = b.hash and a.project_name < b.project_name
+           where (a.project_year, a.project_semester) > (b.project_year, b.project_semester)
+       ) group by year_a, semester_a, year_b, semester_b''',
+    'drop table temp.duplicate_projects',
+]
+
+
+# (Re)build the duplicate index of the database. Returns the number of duplicated hashes.
+def build_duplicate_index(database):
+    connection = sqlite3.connect(database, isolation_level=None)
+    connection.execute('pragma temp_store = memory')
+    connection.execute('begin')
+    for table in duplicate_tables:
+        connection.execute(f'drop table if exists {table}')
+    for statement in duplicate_index_statements:
+        connection.execute(statement)
+    connection.execute('commit')
+    connection.execute('analyze')
+    hash_count = connection.execute('select count() from duplicate_hashes').fetchone()[0]
+    connection.close()
+    return hash_count
+
+
+def has_duplicate_index(connection):
+    return connection.execute("select count() from sqlite_master where type = 'table' and name = 'duplicate_hashes'").fetchone()[0] > 0
+
+
+def format_bytes(size):
+    return f'{(size or 0) / 1073741824:,.2f} GB'
+
+
+# Unverified projects have no year or semester
+def semester_label(year, semester):
+    return f'{year} S{semester}' if year != '' else 'Unverified'
+
+
+def print_duplicate_report(database, limit=20):
+    connection = sqlite3.connect(database)
+
+    hashes, files, saved_bytes = connection.execute('select count(), sum(file_count), sum(saved_bytes) from duplicate_hashes').fetchone()
+    hashed_files, hashed_bytes = connection.execute("select count(), sum(size) from droid_ids where hash != '' and type != 'Folder'").fetchone()
+    cross_project = connection.execute('select count(), sum(saved_bytes) from duplicate_hashes where project_count > 1').fetchone()
+    cross_semester = connection.execute('select count(), sum(saved_bytes) from duplicate_hashes where semester_count > 1').fetchone()
+
+    print('## Duplicate content')
+    print(f'1. Hashed files: {format_number(hashed_files)} ({format_bytes(hashed_bytes)})')
+    print(f'2. Files sharing their content with another file: {format_number(files or 0)} over {format_number(hashes)} hashes')
+    print(f'3. Saved by keeping one copy of each: {format_bytes(saved_bytes)} ({(saved_bytes or 0) / (hashed_bytes or 1):.1%} of the hashed bytes)')
+    print(f'4. Hashes in more than one project: {format_number(cross_project[0])}, {format_bytes(cross_project[1])} of the savings')
+    print(f'5. Hashes in more than one semester: {format_number(cross_semester[0])}, {format_bytes(cross_semester[1])} of the savings')
+    print()
+
+    print('### Largest savings by hash')
+    values = connection.execute('select hash, (select filename from droid_ids where id = (select min(file_id) from duplicate_files '
+                                'where duplicate_files.hash = duplicate_hashes.hash)), size, file_count, project_count, saved_bytes '
+                                'from duplicate_hashes order by saved_bytes desc limit :limit', {'limit': limit}).fetchall()
+    output_as_markdown_table(['Hash', 'Example File', 'Size', 'Copies', 'Projects', 'Saved'],
+                             [[hash[:16], name, format_number(size), copies, projects, format_bytes(saved)] for hash, name, size, copies, projects, saved in values])
+    print()
+
+    print('### Projects sharing the most content')
+    values = connection.execute('select project_a, project_b, shared_hashes, shared_bytes from duplicate_project_overlap '
+                                'order by shared_bytes desc limit :limit', {'limit': limit}).fetchall()
+    output_as_markdown_table(['Project', 'Project', 'Shared Hashes', 'Shared'],
+                             [[a, b, format_number(shared), format_bytes(size)] for a, b, shared, size in values])
+    print()
+
+    # Shared GB between the projects of every pair of semesters, the diagonal is shared within a semester
+    print('### Shared content between semesters (GB)')
+    overlap = {}
+    semesters = set()
+    for year_a, semester_a, year_b, semester_b, size in connection.execute('select year_a, semester_a, year_b, semester_b, shared_bytes from duplicate_semester_overlap'):
+        a, b = semester_label(year_a, semester_a), semester_label(year_b, semester_b)
+        overlap[a, b] = overlap[b, a] = size
+        semesters.update((a, b))
+    semesters = sorted(semesters)
+    output_as_markdown_table([''] + semesters,
+                             [[a] + [f'{overlap[a, b] / 1073741824:,.2f}' if (a, b) in overlap else '' for b in semesters] for a in semesters])
+    connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report duplicated content across the projects and semesters of a droid database.')
+    parser.add_argument('database', nargs='?', help='database to report on (default: the newest ETC_Droid_DB_*.db here)')
+    parser.add_argument('--build', action='store_true', help='rebuild the duplicate index, it is built when missing either way')
+    parser.add_argument('--limit', type=int, default=20, help='rows in the top hash and project pair tables (default: 20)')
+    args = parser.parse_args()
+
+    database = args.database or sorted(file for file in listdir() if file.startswith('ETC_Droid_DB_') and file.endswith('.db'))[-1]
+    if args.build or not has_duplicate_index(sqlite3.connect(database)):
+        start_time = time()
+        hash_count = build_duplicate_index(database)
+        print(f'Built the duplicate index of {database}: {hash_count:,} duplicated hashes in {time() - start_time:.1f}s.\n')
+    print_duplicate_report(database, args.limit)
@@ -0,0 +1,127 @@
+# The droid tables as typed pandas DataFrames for the notebook analyses, streamed from SQLite in chunks.
+# Low cardinality strings are categorical, ids and sizes int64, project year/semester nullable integers and
+# last_modified datetime64, so group-bys over millions of rows run vectorized in a few hundred MB.
+#
+# Only the columns asked for are read, and where is a SQL predicate with :named parameters that SQLite applies
+# before anything reaches pandas, e.g.
+#   read_frame(database, 'droid_ids', ['project_name', 'type', 'size'], where='project_year = :year', parameters={'year': 2017})
+import sqlite3
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Rows fetched from SQLite per DataFrame chunk
+FRAME_CHUNK_ROWS = 500000
+
+# Format SQLAlchemy and the compact views store last_modified in
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+frame_dtypes = {
+    'droid_ids': {
+        'id':                'int64',
+        'parent_id':         'int64',
+        'uri':               'object',
+        'file_path':         'object',
+        'filename':          'object',
+        'id_method':         'category',
+        'status':            'category',
+        'size':              'int64',
+        'type':              'category',
+        'file_extension':    'category',
+        'last_modified':     'datetime64[ns]',
+        'ext_mis_warning':   'category',
+        'hash':              'object',
+        'file_format_count': 'int64',
+        'project_name':      'category',
+        'project_year':      'Int16',
+        'project_semester':  'Int16',
+    },
+    'droid_formats': {
+        'id':                  'int64',
+        'file_id':             'int64',
+        'pronom_id':           'category',
+        'mime_type':           'category',
+        'file_format_name':    'category',
+        'file_format_version': 'category',
+    },
+}
+
+
+def to_typed_column(values, dtype):
+    if dtype == 'category':
+        return values.astype('category')
+    if dtype == 'int64':
+        return pd.to_numeric(values).fillna(0).astype('int64')
+    if dtype == 'Int16':
+        # Unverified projects have '' for year and semester
+        return pd.to_numeric(values, errors='coerce').astype('Int16')
+    if dtype == 'datetime64[ns]':
+        return pd.to_datetime(values, format=TIMESTAMP_FORMAT, errors='coerce')
+    return values
+
+
+# Yield the rows of table as typed DataFrames of at most chunk_rows rows
+def iter_frames(database, table, columns=None, where=None, parameters=None, chunk_rows=FRAME_CHUNK_ROWS):
+    dtypes = frame_dtypes[table]
+    columns = columns or list(dtypes)
+    query = f'select {", ".join(columns)} from {table}'
+    if where:
+        query += f' where {where}'
+
+    connection = sqlite3.connect(database)
+    try:
+        cursor = connection.execute(query, parameters or {})
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                return
+            frame = pd.DataFrame.from_records(rows, columns=columns)
+            for column in columns:
+                frame[column] = to_typed_column(frame[column], dtypes[column])
+            yield frame
+    finally:
+        connection.close()
+
+
+# The whole selection as one DataFrame. The chunks' categories are merged, so the columns stay categorical.
+def read_frame(database, table, columns=None, where=None, parameters=None, chunk_rows=FRAME_CHUNK_ROWS):
+    frames = list(iter_frames(database, table, columns, where, parameters, chunk_rows))
+    if len(frames) == 0:
+        columns = columns or list(frame_dtypes[table])
+        return pd.DataFrame({column: to_typed_column(pd.Series([], dtype='object'), frame_dtypes[table][column]) for column in columns})
+    if len(frames) == 1:
+        return frames[0]
+
+    merged = {}
+    for column in frames[0].columns:
+        if frame_dtypes[table][column] == 'category':
+            merged[column] = pd.Series(union_categoricals([frame[column] for frame in frames]))
+        else:
+            merged[column] = pd.concat([frame[column] for frame in frames], ignore_index=True)
+    return pd.DataFrame(merged)
+
+
+# The publication analyses as group-bys over the frames
+
+# Files per format name and version, like the extension/format table of Publication_Queries.ipynb
+def format_distribution(database, limit=20):
+    files = read_frame(database, 'droid_ids', ['id', 'file_extension', 'size'], where="type = 'File'")
+    formats = read_frame(database, 'droid_formats', ['file_id', 'file_format_name', 'file_format_version'], where="file_format_name != ''")
+    joined = formats.merge(files, left_on='file_id', right_on='id')
+    counts = joined.groupby(['file_extension', 'file_format_name', 'file_format_version'], observed=True).size()
+    return counts.sort_values(ascending=False).head(limit)
+
+
+# Aggregate size in GB per format name and version
+def size_per_format(database, limit=20):
+    files = read_frame(database, 'droid_ids', ['id', 'size'], where="type = 'File'")
+    formats = read_frame(database, 'droid_formats', ['file_id', 'file_format_name', 'file_format_version'], where="file_format_name != ''")
+    joined = formats.merge(files, left_on='file_id', right_on='id')
+    sizes = joined.groupby(['file_format_name', 'file_format_version'], observed=True)['size'].sum()
+    return (sizes.sort_values(ascending=False).head(limit) / 1073741824).round(2)
+
+
+# Files and bytes per project
+def files_per_project(database, limit=20):
+    files = read_frame(database, 'droid_ids', ['project_name', 'size'], where="type != 'Folder'")
+    totals = files.groupby('project_name', observed=True)['size'].agg(['count', 'sum'])
+    return totals.sort_values('count', ascending=False).head(limit)
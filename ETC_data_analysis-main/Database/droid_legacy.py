@@ -0,0 +1,142 @@
+# The csv row mapping and project parsing Database Generation.py did before the compiled column plans and the
+# project trie: DictReader rows mapped cell by cell, the project of the ID 2 row for the whole file and
+# parseprojectpath for the paths. benchmark_mapping.py times the loader against it and check_database.py checks
+# loaded databases against it, so it keeps its own copy of everything it needs and does not follow the loader.
+from csv import DictReader
+from datetime import datetime
+from os.path import basename
+from urllib.parse import unquote
+import regex as re
+
+droid_headers_id = ["id", "parent_id", "uri", "file_path", "filename", "id_method", "status", "size", "type", "file_extension", "last_modified", "ext_mis_warning", "hash", "file_format_count"]
+
+droid_int_headers = ["id", "parent_id", "size"]
+droid_date_headers = ["last_modified"]
+
+droid_headers_format = ["id", "file_id", "pronom_id", "mime_type", "file_format_name", "file_format_version"]
+
+key_to_header = {
+    'id':                 'id',
+    'parent_id':          'parent_id',
+    'uri':                'uri',
+    'file_path':          'file_path',
+    'name':               'filename',
+    'method':             'id_method',
+    'status':             'status',
+    'size':               'size',
+    'type':               'type',
+    'ext':                'file_extension',
+    'last_modified':      'last_modified',
+    'extension_mismatch': 'ext_mis_warning',
+    'sha256_hash':        'hash',
+    'format_count':       'file_format_count',
+    'puid':               'pronom_id',
+    'mime_type':          'mime_type',
+    'format_name':        'file_format_name',
+    'format_version':     'file_format_version',
+}
+
+path_regex = re.compile('[0-9]{4}[_-]semester[_-][123]|to-be-sorted-by-semester')
+
+
+def parsepath(path):
+    path = path.replace('\\', '/')
+    if path.endswith('/'):
+        path = path[:-1]
+    return path
+
+
+def parseprojectpath(path):
+    path = parsepath(path).split('/')
+    while len(path) > 0 and not path_regex.fullmatch(path[0]):
+        path = path[1:]
+    return '/' + '/'.join(path)
+
+
+def parsefoldername(path):
+    return basename(parsepath(path))
+
+
+# The project listing as folder name -> (project name, year, semester)
+def parse_project_listing_csv(input_file):
+    parsed_names = {}
+    with open(input_file, 'r', encoding='utf-8') as file:
+        for row in DictReader(file):
+            if row['Parent File Path'] == "":
+                continue
+            parsed_names[parsefoldername(row['Parent File Path'])] = row['Project Name'], row['Year'], row['Semester']
+    return parsed_names
+
+
+# basename is taken after the separators are normalized, like it worked on Windows
+def parse_project_name(file_path, project_name_by_folder_name):
+    folder_name = parsefoldername(file_path)
+    if folder_name in project_name_by_folder_name:
+        return project_name_by_folder_name[folder_name]
+    return f'Unverified Name: {folder_name}', '', ''
+
+
+def map_id_values(row):
+    row_dict = {}
+    for k, value in row.items():
+        if not k:
+            continue
+        key = key_to_header[k.lower()]
+
+        if key in droid_int_headers:
+            row_dict[key] = int(value) if value else 0
+        elif key in droid_date_headers:
+            row_dict[key] = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S') if value else datetime.today()
+        elif key in droid_headers_id:
+            row_dict[key] = value
+    return row_dict
+
+
+def map_format_values(row):
+    new_row_dict_format = {}
+    for k, value in row.items():
+        if not k:
+            continue
+        key = key_to_header[k.lower()]
+
+        if key == 'id':
+            new_row_dict_format[key] = value
+        elif key == 'file_id':
+            new_row_dict_format[key] = int(value) if value else 0
+        elif key in droid_headers_format:
+            new_row_dict_format[key] = value
+    return new_row_dict_format
+
+
+# Read a droid csv file the old way, yielding the mapped ID row and its Format rows like iter_droid_rows does.
+# Every row gets the project of the ID 2 row.
+def iter_droid_rows(file, project_name_by_folder_name):
+    with open(file, 'r', encoding='utf-8') as f:
+        project_name = ''
+        for row in DictReader(f):
+            if row['URI'].endswith('./'):
+                continue
+            if row['FILE_PATH'] == '':
+                uri = row['URI']
+                row['FILE_PATH'] = unquote(uri[uri.index('file://') + len('file://'):])
+            row_id = map_id_values(row)
+            row_format = map_format_values(row)
+            if row_id['id'] == 2:
+                project_name, project_year, project_semester = parse_project_name(row_id['file_path'], project_name_by_folder_name)
+            row_id['project_name'] = project_name
+            row_id['project_year'] = project_year
+            row_id['project_semester'] = project_semester
+            row_id['file_path'] = parseprojectpath(row_id['file_path'])
+            row_id['uri'] = 'file:' + row_id['file_path']
+            row_formats = [row_format]
+            if None in row:
+                extra = row[None]
+                for x in range(0, len(extra), 4):
+                    row_formats.append({
+                        'pronom_id':           extra[x],
+                        'mime_type':           extra[x + 1],
+                        'file_format_name':    extra[x + 2],
+                        'file_format_version': extra[x + 3]
+                    })
+            row_id['format_count'] = len(row_formats)
+            yield row_id, row_formats
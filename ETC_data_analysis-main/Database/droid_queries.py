@@ -0,0 +1,156 @@
+# Query helpers for the notebooks: finding the database, named and parameterized queries with their results
+# cached on disk, and the table/number formatting the notebooks print with.
+#
+# The cache lives in <database>.cache/ and is keyed by the database fingerprint plus the query text and parameters,
+# so re-running a notebook on an unchanged database reads the results back instead of running the aggregates again,
+# and any change to the database starts a fresh cache.
+from os import listdir, makedirs, replace, stat
+from os.path import join, exists
+from shutil import rmtree
+import hashlib
+import json
+import pickle
+import sqlite3
+
+# The queries the notebooks keep running, :name marks a parameter with its default in the dict. This is the one
+# catalogue of them: the notebooks take their query text from here and query_plans.py checks their plans.
+named_queries = {
+    # Publication_Queries.ipynb
+    'extension_format_counts': ("select file_extension, file_format_name, file_format_version, count() from droid_ids "
+                                "join droid_formats on droid_ids.id=droid_formats.file_id where type='File' and file_format_name != '' "
+                                "group by file_extension, file_format_name, file_format_version order by count() desc limit :limit", {'limit': 20}),
+    'format_sizes':            ("select file_format_name, file_format_version, round(sum(size) / 1073741824.0, 2) from droid_ids "
+                                "join droid_formats on droid_ids.id=droid_formats.file_id where type='File' and file_format_name != '' "
+                                "group by file_format_name, file_format_version order by sum(size) desc limit :limit", {'limit': 20}),
+    'total_files':             ('select count() from droid_ids where type = :type', {'type': 'File'}),
+    'total_size':              ('select round(sum(size) / 1073741824.0, 2) from droid_ids', {}),
+    'files_per_project':       ('select project_name, count() from droid_ids group by project_name order by count() desc limit :limit', {'limit': 20}),
+    'identified_files':        ("select count(distinct droid_ids.id) from droid_ids join droid_formats on droid_ids.id=droid_formats.file_id "
+                                "where file_format_name != ''", {}),
+    'distinct_mime_types':     ('select distinct mime_type from droid_formats', {}),
+    'distinct_extensions':     ('select count(distinct file_extension) from droid_ids', {}),
+    'identified_type_files':   ("select count(distinct droid_ids.id) from droid_ids join droid_formats on droid_ids.id=droid_formats.file_id "
+                                "where type = :type and file_format_name != ''", {'type': 'File'}),
+    'unidentified_type_files': ("select count(distinct droid_ids.id) from droid_ids join droid_formats on droid_ids.id=droid_formats.file_id "
+                                "where type = :type and file_format_name = ''", {'type': 'File'}),
+    # Database_Querying.ipynb
+    'unhashed_extension_files': ("select count(*) from droid_ids where file_extension = :extension and hash = ''", {'extension': 'png'}),
+    'distinct_formats':        ('select count(distinct file_format_name) from droid_formats', {}),
+    'top_formats':             ('select file_format_name, count() from droid_formats group by file_format_name order by count() desc limit :limit', {'limit': 20}),
+    'multi_format_files':      ('select droid_ids.id, filename, file_extension, size from droid_ids join droid_formats on droid_ids.id = droid_formats.file_id '
+                                'group by file_id having count(file_id) > 1 order by droid_ids.size desc', {}),
+    'unhashed_files':          ("select count() from droid_ids where hash = ''", {}),
+    'folders':                 ("select count() from droid_ids where type = 'Folder'", {}),
+    'project_sizes':           ('select project_name, sum(size) from droid_ids group by project_name order by sum(size) desc limit :limit', {'limit': 100}),
+    'extension_sizes':         ("select file_extension, sum(size), count(), sum(size) / count() as average from droid_ids "
+                                "join droid_formats on droid_ids.id = droid_formats.file_id where type != 'Folder' group by file_extension order by count() desc", {}),
+    'common_hashes':           ('select avg(size), hash, count() from droid_formats join droid_ids on droid_ids.id = droid_formats.file_id '
+                                'where type = :type group by hash order by count() desc limit :limit', {'type': 'File', 'limit': 20}),
+    'deduplicated_size':       ("select sum(size), count() from (select size, hash from droid_ids where (type='File' or type='Container') group by hash)", {}),
+    'duplicate_files':         ("select sum(total_size), sum(total_count), sum(count) from (select count() as total_count, "
+                                "(count() - 1) as count, sum(size) as total_size from droid_ids where type != 'Folder' group by hash, type) "
+                                "where total_count > 1", {}),
+    'projects':                ('select project_name, project_year, project_semester from droid_ids group by project_name, project_year '
+                                'order by project_year desc, project_semester desc', {}),
+    'unformatted_extensions':  ("select file_extension, count() from droid_ids where type != 'Folder' and file_format_count=0 "
+                                "group by file_extension order by count() desc limit :limit", {'limit': 100}),
+    'flash_files':             ("select file_extension, count() as count, sum(size) as total_size from droid_ids "
+                                "where type != 'Folder' and file_extension in ('swf', 'swd', 'fla') group by file_extension order by count() desc", {}),
+    'extension_files':         ("select file_extension, count() as count, sum(size) as total_size from droid_ids "
+                                "where type != 'Folder' and file_extension = :extension", {'extension': 'png'}),
+    'largest_files':           ('select file_path, size from droid_ids where file_extension = :extension order by size desc limit :limit',
+                                {'extension': 'avi', 'limit': 10}),
+    'empty_folders':           ("select count() from droid_ids where type='Folder' and status='Empty'", {}),
+    # Drill down through droid_tree: the projects, the children of a folder and the formats under it
+    'tree_roots':              ('select droid_tree.id, project_name, filename, subtree_size, subtree_files, subtree_folders from droid_tree '
+                                'join droid_ids on droid_ids.id = droid_tree.id where droid_tree.parent_id is null order by subtree_size desc', {}),
+    'tree_children':           ('select droid_tree.id, filename, type, subtree_size, subtree_files, subtree_folders from droid_tree '
+                                'join droid_ids on droid_ids.id = droid_tree.id where droid_tree.parent_id = :folder_id order by subtree_size desc', {'folder_id': 2}),
+    'tree_formats':            ('select file_format_name, file_count, size from droid_tree_formats where folder_id = :folder_id order by size desc', {'folder_id': 2}),
+}
+
+# Query text -> the default parameters of its named query, so run_query fills them in for the notebooks' query cells
+named_query_defaults = {query: defaults for query, defaults in named_queries.values()}
+
+
+# The newest database in folder
+def find_database(folder='.'):
+    names = sorted(file for file in listdir(folder) if file.startswith('ETC_Droid_DB_') and file.endswith('.db'))
+    if len(names) == 0:
+        raise Exception(f'No ETC_Droid_DB_*.db database found in {folder}.')
+    return join(folder, names[-1]) if folder != '.' else names[-1]
+
+
+# Fingerprint of the database content without reading all of it: SQLite bumps the change counter in the header on
+# every write transaction, together with the page count and the size that covers any change to the data
+def database_fingerprint(database):
+    with open(database, 'rb') as file:
+        header = file.read(100)
+    return hashlib.sha256(header + str(stat(database).st_size).encode()).hexdigest()[:16]
+
+
+# The cache folder of the database, emptied of the results of any other version of it
+def open_query_cache(database):
+    cache_folder = database + '.cache'
+    fingerprint = database_fingerprint(database)
+    if exists(cache_folder):
+        for folder in listdir(cache_folder):
+            if folder != fingerprint:
+                rmtree(join(cache_folder, folder), ignore_errors=True)
+    makedirs(join(cache_folder, fingerprint), exist_ok=True)
+    return join(cache_folder, fingerprint)
+
+
+# Run query on the database with the :name parameters given, reading the result from the cache when it has it.
+# The text of a named query gets its defaults for the parameters not given.
+def run_query(database, query, use_cache=True, **parameters):
+    parameters = dict(named_query_defaults.get(query, {}), **parameters)
+    key = hashlib.sha256(json.dumps([query, parameters], sort_keys=True, default=str).encode()).hexdigest()
+    cache_file = join(open_query_cache(database), key + '.pickle') if use_cache else None
+    if cache_file is not None and exists(cache_file):
+        with open(cache_file, 'rb') as file:
+            return pickle.load(file)
+
+    connection = sqlite3.connect(database)
+    try:
+        result = connection.execute(query, parameters).fetchall()
+    finally:
+        connection.close()
+
+    if cache_file is not None:
+        with open(cache_file + '.tmp', 'wb') as file:
+            pickle.dump(result, file)
+        # Only whole results end up in the cache
+        replace(cache_file + '.tmp', cache_file)
+    return result
+
+
+# Run one of the named_queries, parameters override its defaults
+def named_query(database, name, use_cache=True, **parameters):
+    return run_query(database, named_queries[name][0], use_cache, **parameters)
+
+
+def format_number(number):
+    return f'{number:,}'
+
+
+def output_as_markdown_table(headers, values, center=True):
+    # Get the amount of padding to add
+    sizes = [len(str(header)) for header in headers]
+    for row in values:
+        for index, value in enumerate(row):
+            sizes[index] = max(sizes[index], len(str(value)))
+
+    def print_row(row):
+        print('|', end='')
+        for index, value in enumerate(row):
+            if center:
+                print(f' {str(value).center(sizes[index])} |', end='')
+            else:
+                print(f' {str(value).ljust(sizes[index])} |', end='')
+        print()
+
+    print_row(headers)
+    print('|' + ''.join(f' {"-" * size} |' for size in sizes))
+    for row in values:
+        print_row(row)
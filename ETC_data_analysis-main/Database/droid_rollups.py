@@ -0,0 +1,67 @@
+# The Publication_Queries.ipynb queries answered from the rollup tables built by Database Generation.py,
+# instead of scanning the droid_ids/droid_formats join. Every function takes the notebook's SQLAlchemy connection
+# and returns the same rows as the original query.
+#
+# It is a library for scripts that want those numbers without scanning droid_ids, nothing in the repo calls it. The
+# notebooks and the named_queries of droid_queries.py keep the queries over droid_ids/droid_formats, which also work on
+# databases loaded before the rollup tables existed.
+from sqlalchemy.sql import text
+
+
+def run(conn, query, **parameters):
+    return conn.execute(text(query), parameters).fetchall()
+
+
+# Table 1 of the original analysis: top extensions by count, with their file format and version
+def extension_format_counts(conn, limit=20):
+    return run(conn, 'select file_extension, file_format_name, file_format_version, sum(format_count) from rollup_formats '
+                     "where type = 'File' and file_format_name != '' "
+                     'group by file_extension, file_format_name, file_format_version order by sum(format_count) desc limit :limit', limit=limit)
+
+
+# Table 2 of the original analysis: top known file formats by aggregate size in GB
+def format_sizes_gb(conn, limit=20):
+    return run(conn, 'select file_format_name, file_format_version, round(sum(size) / 1073741824.0, 2) from rollup_formats '
+                     "where type = 'File' and file_format_name != '' "
+                     'group by file_format_name, file_format_version order by sum(size) desc limit :limit', limit=limit)
+
+
+def total_files(conn):
+    return run(conn, "select coalesce(sum(file_count), 0) from rollup_files where type = 'File'")
+
+
+def total_size_gb(conn):
+    return run(conn, 'select round(sum(size) / 1073741824.0, 2) from rollup_files')
+
+
+def files_per_project(conn, limit=20):
+    return run(conn, 'select project_name, sum(file_count) from rollup_files group by project_name order by sum(file_count) desc limit :limit', limit=limit)
+
+
+# Files, folders and containers with at least one named format. A file can be both identified and unidentified
+# when only some of its formats have a name, like in the original queries.
+def identified_file_count(conn):
+    return run(conn, 'select coalesce(sum(file_count), 0) from rollup_files where identified = 1')
+
+
+def distinct_mime_types(conn):
+    return run(conn, 'select distinct mime_type from rollup_formats')
+
+
+def distinct_extension_count(conn):
+    return run(conn, 'select count(distinct file_extension) from rollup_files')
+
+
+# Identified files over all files, both only counting type File
+def identified_ratio(conn):
+    return run(conn, 'select round(1.0 * sum(case when identified = 1 then file_count else 0 end) / sum(file_count), 2) '
+                     "from rollup_files where type = 'File'")
+
+
+def unidentified_file_count(conn):
+    return run(conn, "select coalesce(sum(file_count), 0) from rollup_files where type = 'File' and unidentified = 1")
+
+
+# Files that DROID matched to more than one format
+def multi_format_file_count(conn):
+    return run(conn, 'select coalesce(sum(file_count), 0) from rollup_files where format_rows > 1')
@@ -0,0 +1,104 @@
+# Synthetic DROID csv exports, laid out like the ones droid.py makes, for benchmarking the loader
+# without a DROID install. Project folders use Windows paths, some rows have an empty FILE_PATH so the
+# loader has to fall back to the URI, and some files have extra formats past the header.
+from csv import writer, QUOTE_ALL
+from os import makedirs
+from os.path import join
+from urllib.parse import quote
+import random
+
+droid_csv_header = ['ID', 'PARENT_ID', 'URI', 'FILE_PATH', 'NAME', 'METHOD', 'STATUS', 'SIZE', 'TYPE', 'EXT', 'LAST_MODIFIED',
+                    'EXTENSION_MISMATCH', 'SHA256_HASH', 'FORMAT_COUNT', 'PUID', 'MIME_TYPE', 'FORMAT_NAME', 'FORMAT_VERSION']
+
+# extension: (weight, puid, mime type, format name, format version), an empty puid means DROID could not identify it
+synthetic_extensions = {
+    'png':   (20, 'fmt/11', 'image/png', 'Portable Network Graphics', '1.0'),
+    'jpg':   (12, 'fmt/43', 'image/jpeg', 'JPEG File Interchange Format', '1.01'),
+    'psd':   (8, 'x-fmt/92', 'image/vnd.adobe.photoshop', 'Adobe Photoshop', ''),
+    'wav':   (6, 'fmt/141', 'audio/x-wav', 'Waveform Audio (PCMWAVEFORMAT)', ''),
+    'cs':    (10, 'x-fmt/111', 'text/plain', 'Plain Text File', ''),
+    'doc':   (2, 'fmt/40', 'application/msword', 'Microsoft Word Document', '97-2003'),
+    'max':   (5, '', '', '', ''),
+    'meta':  (15, '', '', '', ''),
+    'unity': (3, '', '', '', ''),
+    'fbx':   (4, 'fmt/1050', '', 'Autodesk FBX', ''),
+}
+
+# Formats DROID reports next to the first one for the files it cannot decide on
+synthetic_extra_formats = [
+    ('fmt/12', 'image/png', 'Portable Network Graphics', '1.1'),
+    ('fmt/44', 'image/jpeg', 'JPEG File Interchange Format', '1.02'),
+]
+
+
+def synthetic_timestamp(rng):
+    return f'{rng.randint(2005, 2021)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}'
+
+
+# Write the export of one project folder with rows rows under it
+def write_droid_csv(file, semester, folder, rows, seed=0):
+    rng = random.Random(seed)
+    extensions = list(synthetic_extensions)
+    weights = [synthetic_extensions[extension][0] for extension in extensions]
+    root = f'D:\\{semester}\\{folder}'
+
+    with open(file, 'w', encoding='utf-8', newline='') as f:
+        csv_writer = writer(f, quoting=QUOTE_ALL)
+        csv_writer.writerow(droid_csv_header)
+        # The semester folder itself, which the loader skips, then the project folder
+        csv_writer.writerow(['1', '', f'file:/D:/{semester}/./', '', '.', '', 'Done', '', 'Folder', '',
+                             synthetic_timestamp(rng), 'false', '', '', '', '', '', ''])
+        csv_writer.writerow(['2', '', f'file:/D:/{semester}/{folder}/', root, folder, '', 'Done', '', 'Folder', '',
+                             synthetic_timestamp(rng), 'false', '', '0', '', '', '', ''])
+
+        folders = [(2, root)]
+        for row_id in range(3, rows + 3):
+            parent_id, parent_path = folders[-1] if rng.random() < 0.7 else rng.choice(folders)
+            if rng.random() < 0.08:
+                name = f'folder_{row_id}'
+                path = f'{parent_path}\\{name}'
+                folders.append((row_id, path))
+                csv_writer.writerow([row_id, parent_id, 'file:/' + quote(path.replace('\\', '/')) + '/', path, name, '', 'Done', '',
+                                     'Folder', '', synthetic_timestamp(rng), 'false', '', '0', '', '', '', ''])
+                continue
+
+            extension = rng.choices(extensions, weights)[0]
+            _, puid, mime_type, format_name, format_version = synthetic_extensions[extension]
+            name = f'asset {row_id}.{extension}'
+            path = f'{parent_path}\\{name}'
+            uri = 'file:/' + quote(path.replace('\\', '/'))
+            file_path = path
+            if rng.random() < 0.02:
+                # Files on a share come with an empty FILE_PATH and a file:// URI
+                uri = 'file://' + quote('/fileserver/etc/' + path[3:].replace('\\', '/'))
+                file_path = ''
+
+            row = [row_id, parent_id, uri, file_path, name, 'Signature' if puid else '', 'Done', int(rng.lognormvariate(10, 2.5)),
+                   'File', extension, synthetic_timestamp(rng), 'false', '%064x' % rng.getrandbits(256),
+                   '1' if puid else '0', puid, mime_type, format_name, format_version]
+            if puid and rng.random() < 0.03:
+                row[13] = '2'
+                row += list(rng.choice(synthetic_extra_formats))
+            csv_writer.writerow(row)
+
+
+# Write a corpus of rows rows spread over files project exports into folder/input, with the project listing next to it
+def write_droid_corpus(folder, rows, files=4, seed=0):
+    makedirs(join(folder, 'input'), exist_ok=True)
+    projects = []
+    for x in range(files):
+        semester = f'{2005 + x // 6}_semester_{x % 3 + 1}'
+        projects.append((semester, f'project{x}', f'Project {x}', 2005 + x // 6, x % 3 + 1))
+
+    with open(join(folder, 'ETC_Past_Projects_Listing.csv'), 'w', encoding='utf-8', newline='') as f:
+        csv_writer = writer(f)
+        csv_writer.writerow(['Project Name', 'Parent File Path', 'Year', 'Semester'])
+        for semester, project_folder, name, year, semester_number in projects:
+            csv_writer.writerow([name, f'D:/{semester}/{project_folder}', year, semester_number])
+
+    csv_files = []
+    for x, (semester, project_folder, _, _, _) in enumerate(projects):
+        file = join(folder, 'input', f'{semester}.{project_folder}.csv')
+        write_droid_csv(file, semester, project_folder, rows // files + (1 if x < rows % files else 0), seed + x)
+        csv_files.append(file)
+    return csv_files
@@ -0,0 +1,56 @@
+# EXPLAIN QUERY PLAN check of the notebook queries (named_queries in droid_queries.py) against the droid indexes.
+# Fails if any of them has to fall back to a full table scan of droid_ids or droid_formats.
+#
+# Usage:
+#   python query_plans.py [database]
+from os import listdir
+from sys import argv
+import sqlite3
+import regex as re
+
+from droid_queries import named_queries
+
+full_scan_regex = re.compile(r'SCAN (TABLE )?(droid_ids|droid_formats)(_compact)?\b(?!.*\bUSING\b)')
+
+
+# The compact views look their strings up per row, so an equality filter on one of them can not seek the index of
+# its id. These queries filter on the extension and read columns no index of the compact tables covers, so on a
+# compact database they read the whole table and are not reported.
+compact_full_scans = {'unhashed_extension_files', 'largest_files'}
+
+
+def is_compact_database(connection):
+    return connection.execute("select type from sqlite_master where name = 'droid_ids'").fetchone() == ('view',)
+
+
+# The named queries whose plans are checked on this database
+def checked_queries(connection):
+    compact = is_compact_database(connection)
+    return [name for name in named_queries if not (compact and name in compact_full_scans)]
+
+
+# Return (name, plan line) for every checked query that scans a whole droid table, planned with its default parameters
+def find_full_scans(connection):
+    full_scans = []
+    for name in checked_queries(connection):
+        query, parameters = named_queries[name]
+        for row in connection.execute(f'explain query plan {query}', parameters):
+            if full_scan_regex.match(row[-1]):
+                full_scans.append((name, row[-1]))
+    return full_scans
+
+
+if __name__ == '__main__':
+    if len(argv) > 1:
+        database = argv[1]
+    else:
+        database = sorted(file for file in listdir() if file.startswith('ETC_Droid_DB_'))[-1]
+    connection = sqlite3.connect(database)
+    full_scans = find_full_scans(connection)
+    for name, detail in full_scans:
+        print(f'Full scan in "{name}": {detail}')
+    checked = checked_queries(connection)
+    print(f'{len(checked) - len({name for name, _ in full_scans})} / {len(checked)} queries use an index.')
+    if len(checked) < len(named_queries):
+        print(f'Not checked on a compact database: {", ".join(name for name in named_queries if name not in checked)}')
+    quit(1 if full_scans else 0)